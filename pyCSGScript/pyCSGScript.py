@@ -1,19 +1,1048 @@
-import pyPolyCSG as csg
 import numpy 
 import copy
+import collections
+import hashlib
+import io
+import itertools
+import operator
+import os
+import tempfile
+import time
+import warnings
+import weakref
 import xml.etree.ElementTree as Et
+import zipfile
+
+try:
+    import pyPolyCSG as csg
+except ImportError:
+    csg = None
+    
+# Part of the standard library since Python 3.2, on Python 2 it is the
+# futures backport. Without it the work of the pools is done serially.
+try:
+    from concurrent import futures
+except ImportError:
+    futures = None
 
 
 default_color = (0.5, 0.5, 0.5, 1)
 default_mat = ""
 coplanarity_threshold = 1e-5
+collinearity_threshold = 1e-9
+
+# The tessellation quality mode, either "preview" or "final". Files are
+# only exported in final quality.
+quality = "final"
+
+# Number of segments around the axis used to tessellate curved
+# primitives for each quality mode. None means the geometry kernel default.
+resolutions = {"preview": 12, "final": None}
+
+# If True boolean operations are not performed immediately, instead an
+# expression graph is built and evaluated only when the geometry is needed
+lazy_evaluation = False
+
+# The name of the geometry kernel in use, one of the keys of backends.
+# Without pyPolyCSG the NumPy reference kernel is used.
+backend = "pyPolyCSG" if csg is not None else "numpy"
 
 
 def _polyhedron_mult_numpy_matrix_4(polyhedron, matrix):
-    # Multiply a numpy matrix for a pyPolyCSG polyhedron
+    # Multiply a numpy matrix for a polyhedron
+    
+    return _kernel().transform(polyhedron, matrix)
+
+
+def _rotation_matrix(axis, origin, angle):
+    # The 4x4 matrix of a rotation by angle degrees around the axis
+    # starting at origin
+    
+    angle_rad = numpy.radians(angle)
+    cos = numpy.cos(angle_rad)
+    sin = numpy.sin(angle_rad)
+    u = numpy.asarray(axis, dtype=numpy.float64)
+    u = u / numpy.linalg.norm(u)
+    cross_u = numpy.array([[0.0, -u[2], u[1]],
+                           [u[2], 0.0, -u[0]],
+                           [-u[1], u[0], 0.0]])
+    
+    # Rodrigues' formula, then move the center of rotation to origin
+    origin = numpy.asarray(origin, dtype=numpy.float64)
+    matrix = numpy.identity(4)
+    matrix[:3, :3] = (cos * numpy.identity(3) + sin * cross_u +
+                      (1.0 - cos) * numpy.outer(u, u))
+    matrix[:3, 3] = origin - matrix[:3, :3].dot(origin)
+    return matrix
+
+
+def _scale_matrix(factor, origin):
+    # The 4x4 matrix of a scale by factor respect to origin
+    
+    # A single number scales all the axes
+    factor = numpy.ones(3) * numpy.asarray(factor, dtype=numpy.float64)
+    origin = numpy.asarray(origin, dtype=numpy.float64)
+    matrix = numpy.identity(4)
+    matrix[:3, :3] = numpy.diag(factor)
+    matrix[:3, 3] = origin - factor * origin
+    return matrix
+
+
+def _transform_points(points, matrix):
+    # Apply an affine 4x4 matrix to a (N, 3) array of points
+    
+    return points.dot(matrix[:3, :3].T) + matrix[:3, 3]
+
+
+def _is_identity(matrix):
+    # Check if a 4x4 matrix is the identity
+    
+    return numpy.array_equal(matrix, _identity)
+
+
+_identity = numpy.identity(4)
+
+
+def _polyhedron_from_arrays(vertices, triangles):
+    # Make a polyhedron from a (N, 3) array of vertices and a (M, 3)
+    # array of triangle indices
+    
+    return _kernel().from_arrays(vertices, triangles)
+
+
+def _mesh_arrays(polyhedron, transform):
+    # The vertices and triangles arrays of the polyhedron, transformed
+    # by the 4x4 transform unless it is None. Mirroring transforms
+    # reverse the triangles, as the transform of the kernels does.
+    
+    vertices = polyhedron.get_vertices()
+    triangles = polyhedron.get_triangles()
+    if transform is not None:
+        vertices = _transform_points(vertices, transform)
+        if numpy.linalg.det(transform[:3, :3]) < 0.0:
+            triangles = triangles[:, ::-1]
+    return vertices, triangles
+
+
+def _concatenate_polyhedra(polyhedra):
+    # Make a polyhedron with the meshes of all the polyhedra, with no
+    # boolean processing. Only meaningful for disjoint polyhedra.
+    
+    vertices = []
+    triangles = []
+    count = 0
+    for polyhedron in polyhedra:
+        vertices.append(polyhedron.get_vertices())
+        triangles.append(polyhedron.get_triangles() + count)
+        count += len(vertices[-1])
+    return _polyhedron_from_arrays(numpy.vstack(vertices),
+                                   numpy.vstack(triangles))
+
+
+def _save_temporary(polyhedron, directory = None):
+    # Save the polyhedron to a new temporary file in the exchange format
+    # of the kernel and return its path
+    
+    kernel = _kernel()
+    fd, filename = tempfile.mkstemp(prefix=".", suffix=kernel.exchange_format,
+                                    dir=directory)
+    os.close(fd)
+    try:
+        kernel.save(polyhedron, filename)
+    except:
+        os.remove(filename)
+        raise
+    return filename
+
+
+def _bounding_boxes_overlap(first, second):
+    # Check if two bounding boxes overlap, boxes touching each other
+    # are considered overlapping. An empty box (None) overlaps nothing.
+    
+    if first is None or second is None:
+        return False
+    return bool(numpy.all(first[0] <= second[1]) and
+                numpy.all(second[0] <= first[1]))
+
+
+class GeometryBackend(object):
+    """The interface of the geometry kernels computing the meshes.
+    
+    Primitives and CSGObjects build, transform and combine polyhedra
+    only through the kernel selected by the backend module variable.
+    Polyhedra are opaque to pyCSGScript, except that they must provide
+    get_vertices() and get_triangles() returning the (N, 3) array of
+    vertices and the (M, 3) array of triangle indices.
+    A kernel must implement empty, from_arrays and boolean. The other
+    methods have implementations built on those, which kernels can
+    override with native ones.
+    
+    Kernels whose from_arrays has to serialize the arrays set native_arrays
+    to False: then disjoint operands of pending operations are united by
+    the kernel instead of being concatenated one pair at a time, while
+    patterns and merged clusters are still concatenated with a single
+    from_arrays call, and geometry is moved to and from files with save
+    and load in the exchange_format of the kernel.
+    
+    """
+    
+    # True if from_arrays builds polyhedra directly from the arrays
+    native_arrays = True
+    
+    # The extension of the mesh files written and read fastest by save
+    # and load
+    exchange_format = ".npz"
+    
+    # The extensions of the mesh files that load reads without the NumPy
+    # readers of pyCSGScript
+    native_formats = ()
+    
+    def version(self):
+        """A string identifying the version of the kernel."""
+        return ""
+    
+    def empty(self):
+        """Return an empty polyhedron."""
+        raise NotImplementedError()
+    
+    def from_arrays(self, vertices, triangles):
+        """Return the polyhedron with the (N, 3) array of vertices and \
+        the (M, 3) array of triangle indices."""
+        raise NotImplementedError()
+    
+    def boolean(self, operator_, first, second):
+        """Return the result of the boolean operation between two \
+        polyhedra: operator.add for the union, operator.mul for the \
+        intersection, operator.sub for the difference and operator.xor \
+        for the symmetric difference."""
+        raise NotImplementedError()
+    
+    def transform(self, polyhedron, matrix):
+        """Return the polyhedron transformed by the 4x4 matrix."""
+        
+        triangles = polyhedron.get_triangles()
+        if numpy.linalg.det(matrix[:3, :3]) < 0.0:
+            triangles = triangles[:, ::-1]
+        return self.from_arrays(_transform_points(polyhedron.get_vertices(),
+                                                  matrix),
+                                triangles)
+    
+    def box(self, width, height, depth):
+        """Return a box centered at the origin."""
+        
+        corners = numpy.array(list(itertools.product((-0.5, 0.5), repeat=3)))
+        faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6),
+                 (0, 2, 6, 4), (1, 5, 7, 3)]
+        triangles = [(a, b, c) for a, b, c, d in faces] + \
+                    [(a, c, d) for a, b, c, d in faces]
+        return self.from_arrays(corners * [width, height, depth], triangles)
+    
+    def sphere(self, radius):
+        """Return a sphere centered at the origin."""
+        return self.from_arrays(*_sphere_arrays(radius,
+                                                _generated_resolution(None)))
+    
+    def cylinder(self, radius, height):
+        """Return a cylinder with the base centered at the origin, along \
+        the y axis."""
+        return self.from_arrays(*_cylinder_arrays(radius, height,
+                                                  _generated_resolution(None)))
+    
+    def cone(self, radius, height):
+        """Return a cone with the base centered at the origin, along the \
+        y axis."""
+        return self.from_arrays(*_cone_arrays(radius, height,
+                                              _generated_resolution(None)))
+    
+    def torus(self, radius_major, radius_minor):
+        """Return a torus centered at the origin, around the y axis."""
+        return self.from_arrays(*_torus_arrays(radius_major, radius_minor,
+                                               _generated_resolution(None)))
+    
+    def extrusion(self, vertices, vector):
+        """Return the extrusion by vector of the planar polygon with the \
+        (N, 3) array of vertices. A zero vector gives the flat polygon."""
+        
+        vertices = numpy.asarray(vertices, dtype=numpy.float64)
+        vector = numpy.asarray(vector, dtype=numpy.float64)
+        if not numpy.any(vector):
+            triangles = _triangulate_ring(vertices)
+            return self.from_arrays(vertices, numpy.vstack(
+                                        (triangles, triangles[:, ::-1])))
+        return self.from_arrays(*_solid_arrays(numpy.array([vertices,
+                                                            vertices + vector]),
+                                               False))
+    
+    def load(self, filename):
+        """Return the polyhedron loaded from a mesh file."""
+        
+        if filename.endswith(".npz"):
+            with open(filename, "rb") as f:
+                data = numpy.load(f)
+                return self.from_arrays(data["vertices"], data["triangles"])
+        return self.from_arrays(*_read_mesh_arrays(filename))
+    
+    def save(self, polyhedron, filename):
+        """Save the polyhedron to a NumPy .npz, OBJ, binary STL or \
+        binary PLY mesh file, chosen by the extension."""
+        
+        if filename.endswith(".npz"):
+            with open(filename, "wb") as f:
+                numpy.savez(f, vertices=polyhedron.get_vertices(),
+                            triangles=polyhedron.get_triangles())
+        elif filename.endswith(".obj"):
+            with open(filename, "w") as f:
+                numpy.savetxt(f, polyhedron.get_vertices(),
+                              fmt="v %.17g %.17g %.17g")
+                numpy.savetxt(f, polyhedron.get_triangles() + 1,
+                              fmt="f %d %d %d")
+        elif filename.endswith(".stl"):
+            _write_stl([(polyhedron, None, 0)], filename)
+        elif filename.endswith(".ply"):
+            _write_ply([(polyhedron, None, 0)], filename)
+        else:
+            raise ValueError("Unsupported mesh format: " + filename)
+
+
+class PyPolyCSGBackend(GeometryBackend):
+    """The geometry kernel of pyPolyCSG, based on carve."""
+    
+    # The binding has no array constructor, meshes are read from files
+    native_arrays = False
+    exchange_format = ".obj"
+    native_formats = (".obj",)
+    
+    def version(self):
+        # If the module does not provide a version, its file size and time
+        # are used
+        
+        version = getattr(csg, "__version__", None)
+        if version is not None:
+            return str(version)
+        filename = getattr(csg, "__file__", "")
+        if os.path.exists(filename):
+            stat = os.stat(filename)
+            return "{0}:{1}:{2}".format(filename, stat.st_size,
+                                        stat.st_mtime)
+        return filename
+    
+    def empty(self):
+        return csg.polyhedron()
+    
+    def from_arrays(self, vertices, triangles):
+        # pyPolyCSG can only build arbitrary meshes by loading them, so
+        # the arrays are written to a temporary OBJ file
+        
+        fd, filename = tempfile.mkstemp(suffix=".obj")
+        try:
+            with os.fdopen(fd, "w") as f:
+                numpy.savetxt(f, vertices, fmt="v %.17g %.17g %.17g")
+                numpy.savetxt(f, numpy.asarray(triangles) + 1,
+                              fmt="f %d %d %d")
+            polyhedron = csg.polyhedron()
+            polyhedron.load_mesh(filename)
+        finally:
+            os.remove(filename)
+        return polyhedron
+    
+    def boolean(self, operator_, first, second):
+        return operator_(first, second)
+    
+    def transform(self, polyhedron, matrix):
+        elements = numpy.asarray(matrix, dtype=numpy.float64).ravel().tolist()
+        return polyhedron.mult_matrix_4(elements)
+    
+    def box(self, width, height, depth):
+        return csg.box(width, height, depth)
+    
+    def sphere(self, radius):
+        return csg.sphere(radius, True)
+    
+    def cylinder(self, radius, height):
+        return csg.cylinder(radius, height, True).translate(0, height/2.0, 0)
+    
+    def cone(self, radius, height):
+        return csg.cone(radius, height, True).translate(0, height/2.0, 0)
+    
+    def torus(self, radius_major, radius_minor):
+        return csg.torus(radius_major, radius_minor, True)
+    
+    def extrusion(self, vertices, vector):
+        return csg.extrusion(numpy.asarray(vertices).tolist(), vector[0],
+                             vector[1], vector[2])
+    
+    def load(self, filename):
+        polyhedron = csg.polyhedron()
+        polyhedron.load_mesh(filename)
+        return polyhedron
+    
+    def save(self, polyhedron, filename):
+        polyhedron.save_mesh(filename)
+
+
+class _ArrayPolyhedron(object):
+    # The polyhedra of the NumPy kernel, holding read only arrays of
+    # vertices and triangle indices
+    
+    def __init__(self, vertices, triangles):
+        self._vertices = numpy.array(vertices, dtype=numpy.float64).reshape(
+                                                                        -1, 3)
+        self._triangles = numpy.array(triangles, dtype=numpy.int64).reshape(
+                                                                        -1, 3)
+        self._vertices.flags.writeable = False
+        self._triangles.flags.writeable = False
+        
+    def get_vertices(self):
+        return self._vertices
+    
+    def get_triangles(self):
+        return self._triangles
+    
+    
+class NumPyBackend(GeometryBackend):
+    """A reference geometry kernel written with NumPy.
+    
+    Primitives, transforms, extrusions and files are fully supported.
+    Boolean operations are only supported between polyhedra that are
+    empty or have disjoint bounding boxes, where no mesh intersection is
+    needed, otherwise NotImplementedError is raised.
+    
+    """
+    
+    def version(self):
+        return numpy.__version__
+    
+    def empty(self):
+        return _ArrayPolyhedron(numpy.zeros((0, 3)), numpy.zeros((0, 3)))
+    
+    def from_arrays(self, vertices, triangles):
+        return _ArrayPolyhedron(vertices, triangles)
+    
+    def boolean(self, operator_, first, second):
+        vertices = (first.get_vertices(), second.get_vertices())
+        boxes = [(v.min(axis=0), v.max(axis=0)) if len(v) else None
+                 for v in vertices]
+        if boxes[0] is not None and boxes[1] is not None and \
+                _bounding_boxes_overlap(*boxes):
+            raise NotImplementedError("The NumPy kernel cannot combine "
+                                      "overlapping polyhedra")
+        if operator_ is operator.mul:
+            return self.empty()
+        if operator_ is operator.sub:
+            return first
+        return self.from_arrays(numpy.vstack(vertices), numpy.vstack(
+                    (first.get_triangles(),
+                     second.get_triangles() + len(vertices[0]))))
+
+
+# The registered geometry kernels by name
+backends = {}
+
+
+def register_backend(name, kernel):
+    """Register the GeometryBackend kernel with name, so that it can be \
+    selected setting the backend module variable."""
+    
+    backends[name] = kernel
+    
+    
+if csg is not None:
+    register_backend("pyPolyCSG", PyPolyCSGBackend())
+register_backend("numpy", NumPyBackend())
+
+
+def _kernel():
+    # The geometry kernel in use
+    
+    try:
+        return backends[backend]
+    except KeyError:
+        raise ValueError("Unknown geometry backend: " + str(backend))
+
+
+class _TimedBackend(object):
+    # A proxy of a kernel accumulating the time spent in each method
+    
+    def __init__(self, kernel, timings):
+        self._kernel = kernel
+        self._timings = timings
+        
+    def __getattr__(self, name):
+        
+        # Flags such as native_arrays are passed through unchanged
+        method = getattr(self._kernel, name)
+        if not callable(method):
+            return method
+        timings = self._timings
+        
+        def timed(*args):
+            start = time.time()
+            try:
+                return method(*args)
+            finally:
+                timings[name] = (timings.get(name, 0.0) +
+                                 time.time() - start)
+        return timed
+    
+    
+def benchmark_backends(scripts, names = None, repeat = 3):
+    """Time the geometry kernels running the same scripts.
+    
+    Each script file is executed repeat times with each kernel named in
+    names (by default all the registered ones), with the geometry caches
+    disabled, and the pending operations of its objects are evaluated.
+    Return a dictionary mapping each script to a dictionary mapping each
+    kernel name to the best total time in seconds and the times spent
+    in each kernel method during that run, as a (total, {method: time})
+    pair. Nested method calls are timed in both methods.
+    
+    """
+    
+    global backend, disk_cache, boolean_cache, primitive_cache
+    names = sorted(backends) if names is None else list(names)
+    
+    # The caches are replaced by disabled ones for the benchmark, so
+    # that the entries of the user's caches are kept
+    saved = (backend, disk_cache, boolean_cache, primitive_cache)
+    results = {}
+    try:
+        disk_cache = None
+        boolean_cache = GeometryCache(0)
+        primitive_cache = GeometryCache(0)
+        for script in scripts:
+            with open(script) as f:
+                code = compile(f.read(), script, "exec")
+            results[script] = {}
+            for name in names:
+                kernel = backends[name]
+                best = None
+                for _ in range(repeat):
+                    timings = {}
+                    backends[name] = _TimedBackend(kernel, timings)
+                    backend = name
+                    try:
+                        start = time.time()
+                        namespace = {"__name__": "__main__"}
+                        exec(code, namespace)
+                        for value in list(namespace.values()):
+                            if isinstance(value, CSGObject):
+                                value.evaluate()
+                        total = time.time() - start
+                    finally:
+                        backends[name] = kernel
+                    if best is None or total < best[0]:
+                        best = (total, timings)
+                results[script][name] = best
+    finally:
+        backend = saved[0]
+        disk_cache = saved[1]
+        boolean_cache = saved[2]
+        primitive_cache = saved[3]
+    return results
+
+
+class _CSGOperation(object):
+    """A node of the CSG expression graph, representing a boolean \
+    operation between two CSGObjects.
+    
+    The result is computed once, in global space coordinates, and shared
+    by all the objects that refer to the node.
+    
+    """
+    
+    def __init__(self, operator_, first, second):
+        
+        # The polyhedron operator to apply
+        self.operator = operator_
+        
+        # The two operands
+        self.operands = (first, second)
+        
+        # The resulting polyhedron, None until evaluated
+        self.polyhedron = None
+        
+        # The content hash of the result, set on evaluation if the
+        # boolean cache is enabled
+        self.digest = None
+        
+    def evaluate(self):
+        """Evaluate the graph below this node and return the resulting \
+        polyhedron."""
+        
+        # Sort the pending nodes in post-order with an explicit stack,
+        # chains of hundreds of operations would exceed the recursion limit
+        pending = []
+        visited = set([])
+        stack = [(self, False)]
+        while stack:
+            node, expanded = stack.pop()
+            if expanded:
+                pending.append(node)
+                continue
+            if node.polyhedron is not None or id(node) in visited:
+                continue
+            visited.add(id(node))
+            stack.append((node, True))
+            for operand in node.operands:
+                if operand._operation is not None:
+                    stack.append((operand._operation, False))
+                    
+        for node in pending:
+            node._apply()
+        return self.polyhedron
+    
+    def _apply(self):
+        # Compute the result, looking it up in the caches first
+        
+        if not self._lookup():
+            self._store(self._compute(*self.operands))
+            
+    def _lookup(self):
+        # Look the result up in the caches, return True if found.
+        # On success the operands are released.
+        
+        if boolean_cache.memory_budget <= 0 and disk_cache is None:
+            return False
+        self.digest = _operation_digest(self.operator, *self.operands)
+        polyhedron = _cache_get(self.digest)
+        if polyhedron is None:
+            return False
+        self.polyhedron = polyhedron
+        self.operands = ()
+        return True
+    
+    def _store(self, polyhedron):
+        # Set the computed result, adding it to the caches, and release
+        # the operands since they are no longer needed
+        
+        self.polyhedron = polyhedron
+        self.operands = ()
+        if self.digest is not None:
+            _cache_put(self.digest, polyhedron)
+        
+    def _compute(self, first, second):
+        # Apply the operator to the global polyhedra of the operands and
+        # return the result, in global space coordinates
+        
+        # Objects whose bounding boxes do not overlap need no boolean
+        # processing: the union is the concatenation of the meshes, the
+        # intersection is empty and the difference is the first object.
+        # Concatenating is only faster if the kernel builds meshes from
+        # arrays natively.
+        if (_bounding_boxes_overlap(first.bounding_box, second.bounding_box) or
+                (self.operator in (operator.add, operator.xor) and
+                 not _kernel().native_arrays)):
+            return _kernel().boolean(self.operator, first.global_polyhedron,
+                                     second.global_polyhedron)
+        elif self.operator in (operator.add, operator.xor):
+            return _concatenate_polyhedra([first.global_polyhedron,
+                                           second.global_polyhedron])
+        elif self.operator is operator.mul:
+            return _kernel().empty()
+        else:
+            return first.global_polyhedron
+
+
+def _polyhedron_digest(polyhedron):
+    # Hash the content of a polyhedron
+    
+    digest = hashlib.sha1()
+    vertices = polyhedron.get_vertices()
+    triangles = polyhedron.get_triangles()
+    digest.update(numpy.ascontiguousarray(vertices, numpy.float64).tobytes())
+    digest.update(numpy.ascontiguousarray(triangles, numpy.int64).tobytes())
+    return digest.hexdigest()
+
+
+def _polyhedron_nbytes(polyhedron):
+    # Estimate the memory used by a polyhedron
+    
+    return (polyhedron.get_vertices().nbytes +
+            polyhedron.get_triangles().nbytes)
+
+
+def _operation_digest(operator_, first, second):
+    # Hash an operation from the operator and the geometry and transform
+    # of both operands. The digest identifies the result as well.
+    
+    digest = hashlib.sha1((backend + operator_.__name__).encode("ascii"))
+    for operand in (first, second):
+        digest.update(operand._digest().encode("ascii"))
+        transform = numpy.ascontiguousarray(operand.global_transform)
+        digest.update(transform.tobytes())
+    return digest.hexdigest()
+
+
+class GeometryCache(object):
+    """An in-memory cache of polyhedra keyed by content hashes.
+    
+    When the memory used by the cached polyhedra exceeds memory_budget
+    (in bytes) the least recently used entries are evicted.
+    A memory_budget of zero disables the cache.
+    
+    """
+    
+    def __init__(self, memory_budget):
+        
+        # Cached (polyhedron, size) pairs, least recently used first
+        self._entries = collections.OrderedDict()
+        
+        # The estimated memory used by the cached polyhedra
+        self._memory_usage = 0
+        
+        self._memory_budget = memory_budget
+        
+    @property
+    def memory_budget(self):
+        """The maximum memory used by the cached polyhedra, in bytes."""
+        return self._memory_budget
+    
+    @memory_budget.setter
+    def memory_budget(self, value):
+        self._memory_budget = value
+        self._evict()
+        
+    @property
+    def memory_usage(self):
+        """The estimated memory used by the cached polyhedra, in bytes."""
+        return self._memory_usage
+    
+    def get(self, key):
+        """Return the polyhedron cached with key, or None."""
+        
+        try:
+            entry = self._entries.pop(key)
+        except KeyError:
+            return None
+        self._entries[key] = entry
+        return entry[0]
+    
+    def put(self, key, polyhedron):
+        """Cache the polyhedron with key, evicting old entries if needed."""
+        
+        if key in self._entries:
+            self._memory_usage -= self._entries.pop(key)[1]
+        size = _polyhedron_nbytes(polyhedron)
+        if size > self._memory_budget:
+            return
+        self._entries[key] = (polyhedron, size)
+        self._memory_usage += size
+        self._evict()
+        
+    def clear(self):
+        """Remove all the cached polyhedra."""
+        
+        self._entries.clear()
+        self._memory_usage = 0
+        
+    def _evict(self):
+        # Remove the least recently used entries until the memory usage
+        # is within the budget
+        
+        while self._entries and self._memory_usage > self._memory_budget:
+            self._memory_usage -= self._entries.popitem(last=False)[1][1]
+
+
+class DiskGeometryCache(object):
+    """A persistent cache of polyhedra stored in a directory.
+    
+    Polyhedra are stored as files named after their keys, in the
+    exchange format of the kernel: NumPy .npz files by default, OBJ files
+    written and read natively by pyPolyCSG.
+    Keys are combined with the name and version of the geometry kernel,
+    so results computed by a different kernel are never reused.
+    When the size of the stored files exceeds size_limit (in bytes) the
+    least recently used files are removed.
+    
+    """
+    
+    def __init__(self, directory, size_limit = 4 * 1024 * 1024 * 1024):
+        
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+            
+        self._size_limit = size_limit
+        
+        # Current size of the stored files
+        self._size = sum(os.path.getsize(path) for path in self._files())
+        self._evict()
+        
+    @property
+    def size_limit(self):
+        """The maximum size of the stored files, in bytes."""
+        return self._size_limit
+    
+    @size_limit.setter
+    def size_limit(self, value):
+        self._size_limit = value
+        self._evict()
+        
+    @property
+    def size(self):
+        """The size of the stored files, in bytes."""
+        return self._size
+        
+    def get(self, key):
+        """Return the polyhedron stored with key, or None."""
+        
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            polyhedron = _kernel().load(path)
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        
+        # Mark the file as recently used
+        os.utime(path, None)
+        return polyhedron
+    
+    def put(self, key, polyhedron):
+        """Store the polyhedron with key, removing old files if needed."""
+        
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        
+        # Write to a temporary file first so that a partially written
+        # file is never read
+        temp_path = _save_temporary(polyhedron, self.directory)
+        try:
+            os.rename(temp_path, path)
+        except:
+            os.remove(temp_path)
+            raise
+        self._size += os.path.getsize(path)
+        self._evict()
+        
+    def clear(self):
+        """Remove all the stored files."""
+        
+        for path in self._files():
+            os.remove(path)
+        self._size = 0
+        
+    def _path(self, key):
+        # The path of the file storing the polyhedron with key
+        
+        digest = hashlib.sha1((_kernel_version() + key).encode("utf-8"))
+        return os.path.join(self.directory,
+                            digest.hexdigest() + _kernel().exchange_format)
     
-    elements = numpy.hstack(numpy.asarray(matrix)).tolist()
-    return polyhedron.mult_matrix_4(elements)
+    def _files(self):
+        # The paths of the stored files, temporary files start with a dot
+        
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if not name.startswith(".")]
+        
+    def _evict(self):
+        # Remove the least recently used files until the size is within
+        # the limit
+        
+        if self._size <= self._size_limit:
+            return
+        for path in sorted(self._files(), key=os.path.getmtime):
+            if self._size <= self._size_limit:
+                break
+            self._size -= os.path.getsize(path)
+            os.remove(path)
+            
+            
+def _kernel_version():
+    # A string identifying the geometry kernel in use and its version
+    
+    return backend + ":" + _kernel().version()
+
+
+def _cache_get(key):
+    # Return the polyhedron with key from the memory or disk cache,
+    # or None
+    
+    polyhedron = boolean_cache.get(key)
+    if polyhedron is None and disk_cache is not None:
+        polyhedron = disk_cache.get(key)
+        if polyhedron is not None and boolean_cache.memory_budget > 0:
+            boolean_cache.put(key, polyhedron)
+    return polyhedron
+
+
+def _cache_put(key, polyhedron):
+    # Add the polyhedron with key to the enabled caches
+    
+    if disk_cache is not None:
+        disk_cache.put(key, polyhedron)
+    if boolean_cache.memory_budget > 0:
+        boolean_cache.put(key, polyhedron)
+
+
+def _primitive_polyhedron(function, *args):
+    # Return the primitive polyhedron made by the function with
+    # args, and its digest. Primitives with the same parameters share the
+    # same polyhedron, placement is only expressed by the transform.
+    
+    key = "{0}:{1}{2!r}".format(backend, function.__name__, args)
+    polyhedron = primitive_cache.get(key)
+    if polyhedron is None:
+        if disk_cache is not None:
+            polyhedron = disk_cache.get(key)
+        if polyhedron is None:
+            polyhedron = function(*args)
+            if disk_cache is not None:
+                disk_cache.put(key, polyhedron)
+        if primitive_cache.memory_budget > 0:
+            primitive_cache.put(key, polyhedron)
+    return polyhedron, hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+def _resolution(resolution):
+    # The resolution to use for a primitive, the given one or the one of
+    # the current quality mode
+    
+    if resolution is not None:
+        return resolution
+    return resolutions[quality]
+
+
+def _revolution_arrays(profile, segments, closed = False):
+    # Return the vertices and triangles arrays of the surface made by
+    # revolving a profile of (radius, y) points around the y axis, with
+    # the given number of segments. Points with zero radius become a
+    # single vertex. The profile must be traversed clockwise in the
+    # (radius, y) plane for the triangles to face outwards. If closed
+    # is True the last point is joined to the first.
+    
+    profile = numpy.asarray(profile, dtype=numpy.float64)
+    angles = numpy.linspace(0.0, 2.0 * numpy.pi, segments, endpoint=False)
+    cos = numpy.cos(angles)
+    sin = numpy.sin(angles)
+    j = numpy.arange(segments)
+    next_j = (j + 1) % segments
+    
+    vertices = []
+    rings = []
+    count = 0
+    for radius, y in profile:
+        if radius == 0.0:
+            vertices.append([[0.0, y, 0.0]])
+            rings.append(numpy.repeat(count, segments))
+            count += 1
+        else:
+            vertices.append(numpy.column_stack((radius * cos,
+                                                numpy.repeat(y, segments),
+                                                radius * sin)))
+            rings.append(count + j)
+            count += segments
+            
+    pairs = list(zip(range(len(profile) - 1), range(1, len(profile))))
+    if closed:
+        pairs.append((len(profile) - 1, 0))
+    
+    triangles = []
+    for a, b in pairs:
+        a_pole = profile[a][0] == 0.0
+        b_pole = profile[b][0] == 0.0
+        if not a_pole:
+            triangles.append(numpy.column_stack((rings[a], rings[a][next_j],
+                                                 rings[b])))
+        if not b_pole:
+            triangles.append(numpy.column_stack((rings[a][next_j],
+                                                 rings[b][next_j],
+                                                 rings[b])))
+            
+    return numpy.vstack(vertices), numpy.vstack(triangles)
+
+
+def _box(width, height, depth):
+    # A box centered at the origin
+    
+    return _kernel().box(width, height, depth)
+
+
+def _sphere(radius, resolution):
+    # A sphere centered at the origin
+    
+    if resolution is None:
+        return _kernel().sphere(radius)
+    return _polyhedron_from_arrays(*_sphere_arrays(radius, resolution))
+
+
+def _sphere_arrays(radius, resolution):
+    # The vertices and triangles arrays of a sphere centered at the
+    # origin
+    
+    theta = numpy.linspace(0.0, numpy.pi, max(resolution // 2, 2) + 1)
+    profile = numpy.column_stack((radius * numpy.sin(theta),
+                                  radius * numpy.cos(theta)))
+    profile[0, 0] = profile[-1, 0] = 0.0
+    return _revolution_arrays(profile, resolution)
+
+
+def _cylinder(radius, height, resolution):
+    # A cylinder with the base centered at the origin
+    
+    if resolution is None:
+        return _kernel().cylinder(radius, height)
+    return _polyhedron_from_arrays(*_cylinder_arrays(radius, height,
+                                                     resolution))
+
+
+def _cylinder_arrays(radius, height, resolution):
+    # The vertices and triangles arrays of a cylinder with the base
+    # centered at the origin
+    
+    profile = [(0.0, height), (radius, height), (radius, 0.0), (0.0, 0.0)]
+    return _revolution_arrays(profile, resolution)
+
+
+def _cone(radius, height, resolution):
+    # A cone with the base centered at the origin
+    
+    if resolution is None:
+        return _kernel().cone(radius, height)
+    return _polyhedron_from_arrays(*_cone_arrays(radius, height, resolution))
+
+
+def _cone_arrays(radius, height, resolution):
+    # The vertices and triangles arrays of a cone with the base centered
+    # at the origin
+    
+    profile = [(0.0, height), (radius, 0.0), (0.0, 0.0)]
+    return _revolution_arrays(profile, resolution)
+
+
+def _torus(radius_major, radius_minor, resolution):
+    # A torus centered at the origin, around the y axis
+    
+    if resolution is None:
+        return _kernel().torus(radius_major, radius_minor)
+    return _polyhedron_from_arrays(*_torus_arrays(radius_major, radius_minor,
+                                                  resolution))
+
+
+def _torus_arrays(radius_major, radius_minor, resolution):
+    # The vertices and triangles arrays of a torus centered at the
+    # origin, around the y axis
+    
+    angles = numpy.linspace(0.0, 2.0 * numpy.pi, max(resolution // 2, 3),
+                            endpoint=False)
+    profile = numpy.column_stack(
+                        (radius_major + radius_minor * numpy.sin(angles),
+                         radius_minor * numpy.cos(angles)))
+    return _revolution_arrays(profile, resolution, True)
+
+
+# The cache for the results of boolean operations
+boolean_cache = GeometryCache(256 * 1024 * 1024)
+
+# The cache for the polyhedra shared by primitives with the same
+# parameters
+primitive_cache = GeometryCache(64 * 1024 * 1024)
+
+# The persistent cache for primitives and results of boolean
+# operations, disabled if None. Set it to a DiskGeometryCache to enable.
+disk_cache = None
 
 
 class CSGObject(object):
@@ -29,11 +1058,24 @@ class CSGObject(object):
         # The construction position
         self._pos = pos
         
+        # The pending operation of the expression graph that computes
+        # the polyhedron, if any
+        self._operation = None
+        
+        # The group containing the object, and the stamp of the group
+        # transforms when the global caches were computed
+        self._parent = None
+        self._global_stamp = 0
+        
+        # The bounding volume hierarchy of the local space triangles, built
+        # on the first containment test and shared by copies
+        self._bvh = None
+        
         # The pyPolyCSG polyhedron
         if polyhedron is not None:
             self._polyhedron = polyhedron
         else:
-            self._polyhedron = csg.polyhedron()
+            self._polyhedron = _kernel().empty()
             
         if transform is not None:
             self.transform = transform
@@ -50,7 +1092,7 @@ class CSGObject(object):
         else:    
             self.color = default_color
         
-        self._global_polyhedron = None
+        self._invalidate_global_cache()
     
     @property    
     def pos(self):
@@ -58,73 +1100,176 @@ class CSGObject(object):
         return self._pos
     
     @property
-    def global_polyhedron(self):
-        """The polyhedron in global space coordinates."""
+    def _polyhedron(self):
+        # The polyhedron in local space coordinates, evaluating the
+        # pending operation if needed
         
-        if not self._global_polyhedron:
-            self._global_polyhedron = \
-                _polyhedron_mult_numpy_matrix_4(self._polyhedron,
-                                                self.transform)
+        if self._operation is not None:
+            return self._operation.evaluate()
+        return self._local_polyhedron
+    
+    @_polyhedron.setter
+    def _polyhedron(self, value):
+        self._local_polyhedron = value
+        self._local_digest = None
+        self._operation = None
+        self._invalidate_global_cache()
+    
+    @property
+    def global_polyhedron(self):
+        """The polyhedron in global space coordinates."""
+        
+        self._check_global_cache()
+        if not self._global_polyhedron:
+            global_transform = self.global_transform
+            if _is_identity(global_transform):
+                self._global_polyhedron = self._polyhedron
+            else:
+                self._global_polyhedron = \
+                    _polyhedron_mult_numpy_matrix_4(self._polyhedron,
+                                                    global_transform)
         return self._global_polyhedron
     
+    @property
+    def bounding_box(self):
+        """The axis aligned bounding box in global space coordinates, \
+        as a (min, max) pair of arrays, or None if the object is empty."""
+        
+        self._check_global_cache()
+        if self._bounding_box is False:
+            vertices = self._global_vertices()
+            if len(vertices):
+                self._bounding_box = (vertices.min(axis=0),
+                                      vertices.max(axis=0))
+            else:
+                self._bounding_box = None
+        return self._bounding_box
+    
+    @property
+    def _shared_geometry(self):
+        # The object holding the local space geometry, shared by copies
+        # and instances of this object
+        
+        if self._operation is not None:
+            return self._operation
+        return self._local_polyhedron
+    
+    def _global_vertices(self):
+        # The vertices in global space coordinates. Unless the global
+        # polyhedron is already available they are transformed with
+        # NumPy, without baking the global polyhedron.
+        
+        self._check_global_cache()
+        if self._global_polyhedron:
+            return self._global_polyhedron.get_vertices()
+        vertices = self._polyhedron.get_vertices()
+        global_transform = self.global_transform
+        if _is_identity(global_transform):
+            return vertices
+        return _transform_points(vertices, global_transform)
+    
+    def _global_mesh(self):
+        # The polyhedron and the transform to apply to it to get the
+        # geometry in global space coordinates, None if there is nothing
+        # to apply. The global polyhedron is used if available, but it is
+        # not baked, so that read only uses of the arrays do not keep a
+        # mesh for each instance. See _mesh_arrays.
+        
+        self._check_global_cache()
+        if self._global_polyhedron:
+            return self._global_polyhedron, None
+        global_transform = self.global_transform
+        if _is_identity(global_transform):
+            return self._polyhedron, None
+        return self._polyhedron, global_transform
+    
+    def _digest(self):
+        # The content hash of the polyhedron in local space coordinates.
+        # Results of operations are identified by the operation digest.
+        
+        if self._operation is not None:
+            self._operation.evaluate()
+            if self._operation.digest is not None:
+                return self._operation.digest
+        if self._local_digest is None:
+            self._local_digest = _polyhedron_digest(self._polyhedron)
+        return self._local_digest
+    
+    def _invalidate_global_cache(self):
+        # Invalidate the data cached in global space coordinates
+        
+        self._global_polyhedron = None
+        self._bounding_box = False
+        
+    def _check_global_cache(self):
+        # Invalidate the global caches if any group containing the object
+        # has been transformed since they were computed
+        
+        if self._parent is None:
+            stamp = 0
+        else:
+            stamp = self._parent._stamp_chain()
+        if stamp != self._global_stamp:
+            self._invalidate_global_cache()
+            self._global_stamp = stamp
+        
+    @property
+    def transform(self):
+        """The 4x4 transform matrix from local to global space \
+        coordinates, as a float64 array."""
+        return self._transform
+    
+    @transform.setter
+    def transform(self, value):
+        self._transform = numpy.array(value, dtype=numpy.float64)
+        self._invalidate_global_cache()
+        
+    @property
+    def global_transform(self):
+        """The transform from local to global space coordinates, \
+        including the transforms of the groups containing the object."""
+        
+        if self._parent is None:
+            return self._transform
+        return self._parent.global_transform.dot(self._transform)
+    
+    @property
+    def parent(self):
+        """The CSGGroup containing the object, or None."""
+        return self._parent
         
     def translate(self, offset, local=False):
         """Translate by offset.
         
-        If local is True, use local space coordinates.
+        If local is True, use local space coordinates. For objects in a
+        group, non local coordinates are the ones of the group.
         
         """
         
-        translate_matrix = numpy.matrix([[1.0, 0.0, 0.0, offset[0]], 
-                                         [0.0, 1.0, 0.0, offset[1]],
-                                         [0.0, 0.0, 1.0, offset[2]],
-                                         [0.0, 0.0, 0.0, 1.0]])
+        # Compose without building a translation matrix. The transform
+        # is replaced, not changed in place, as it may be referenced by
+        # the caller or by the preview.
+        offset = numpy.asarray(offset, dtype=numpy.float64)
+        transform = self._transform.copy()
         if local:
-            self.transform = self.transform * translate_matrix
+            transform[:, 3] += transform[:, :3].dot(offset)
         else:
-            self.transform = translate_matrix * self.transform
-        self._global_polyhedron = None
+            transform[:3] += numpy.outer(offset, transform[3])
+        self._transform = transform
+        self._invalidate_global_cache()
         
     def rotate(self, axis, origin, angle):
         """Rotate by angle degrees, around the axis starting at origin."""
         
-        # Convert angle to radinas and calculate sin and cos
-        angle_rad = numpy.radians(angle)
-        cos = numpy.cos(angle_rad)
-        sin = numpy.sin(angle_rad)
-        
-        # Store temporary variables of components
-        np_axis = numpy.array(axis)
-        np_axis = np_axis / numpy.linalg.norm(np_axis)
-        ux, uy, uz = np_axis
-        
-        # Calculate rotation matrix
-        rotation_matrix = numpy.matrix(
-         [[cos + ux*ux*(1-cos), ux*uy*(1-cos) - uz*sin, ux*uz*(1-cos) + uy*sin, 0.0],
-         [uy*ux*(1-cos) + uz*sin, cos + uy*uy*(1-cos), uy*uz*(1-cos) - ux*sin, 0.0],
-         [uz*ux*(1-cos) - uy*sin, uz*uy*(1-cos) + ux*sin, cos + uz*uz*(1-cos), 0.0],
-         [0.0, 0.0, 0.0, 1.0]])
-         
-        # Translate to negative origin, applay rotation ad retranslate
-        # to origin
-        self.translate((-origin[0], -origin[1], -origin[2]))
-        self.transform = rotation_matrix * self.transform
-        self.translate(origin)
-        
-        # Invalidate global polygon cache
-        self._global_polyhedron = None
+        self._transform = _rotation_matrix(axis, origin, angle).dot(
+                                                            self._transform)
+        self._invalidate_global_cache()
         
     def scale(self, factor, origin):
         """Scale by factor respect to origin"""
         
-        scale_matrix = numpy.matrix([[factor[0], 0.0, 0.0, 0.0],
-                                     [0.0, factor[1], 0.0, 0.0],
-                                     [0.0, 0.0, factor[2], 0.0],
-                                     [0.0, 0.0, 0.0, 1.0]])
-        self.translate((-origin[0], -origin[1], -origin[2]))
-        self.transform = scale_matrix * self.transform
-        self.translate(origin)
-        self._global_polyhedron = None
+        self._transform = _scale_matrix(factor, origin).dot(self._transform)
+        self._invalidate_global_cache()
         
     def union(self, csg_object):
         """Return the object union of self and the csg_object.
@@ -134,12 +1279,7 @@ class CSGObject(object):
         
         """
         
-        polyhedron = self.global_polyhedron + csg_object.global_polyhedron
-        polyhedron = _polyhedron_mult_numpy_matrix_4(polyhedron,
-                                            numpy.linalg.inv(self.transform))
-        union_object = CSGObject(self.pos, polyhedron, self.mat, self.color, 
-                                 self.transform)
-        return union_object
+        return self._boolean(operator.add, csg_object)
     
     def intersection(self, csg_object):
         """Return the intersection object of self and the csg_object.
@@ -149,12 +1289,7 @@ class CSGObject(object):
         
         """
         
-        polyhedron = self.global_polyhedron * csg_object.global_polyhedron
-        polyhedron = _polyhedron_mult_numpy_matrix_4(polyhedron,
-                                            numpy.linalg.inv(self.transform))
-        intersection_object = CSGObject(self.pos, polyhedron, self.mat,
-                                        self.color, self.transform)
-        return intersection_object
+        return self._boolean(operator.mul, csg_object)
     
     def difference(self, csg_object):
         """Return the difference object of self and the csg_object.
@@ -164,12 +1299,7 @@ class CSGObject(object):
         
         """
         
-        polyhedron = self.global_polyhedron - csg_object.global_polyhedron
-        polyhedron = _polyhedron_mult_numpy_matrix_4(polyhedron,
-                                            numpy.linalg.inv(self.transform))
-        difference_object = CSGObject(self.pos, polyhedron, self.mat,
-                                      self.color, self.transform)
-        return difference_object
+        return self._boolean(operator.sub, csg_object)
     
     def symmetric_difference(self, csg_object):
         """Return the symmetric_difference object of self and the \
@@ -180,12 +1310,90 @@ class CSGObject(object):
         
         """
         
-        polyhedron = self.global_polyhedron ^ csg_object.global_polyhedron
-        polyhedron = _polyhedron_mult_numpy_matrix_4(polyhedron,
-                                            numpy.linalg.inv(self.transform))
-        symmetric_difference_object = CSGObject(self.pos, polyhedron, self.mat,
-                                                self.color, self.transform)
-        return symmetric_difference_object
+        return self._boolean(operator.xor, csg_object)
+    
+    def union_many(self, csg_objects):
+        """Return the object union of self and all the csg_objects.
+        
+        The objects are clustered by overlapping bounding boxes: each
+        cluster is united with a balanced tree of operations, and the
+        disjoint clusters are merged without boolean processing.
+        Empty objects are left out.
+        Attributes such as creation position, material, color are taken
+        from the self object, even if it is empty.
+        
+        """
+        
+        return _merge_objects([self] + list(csg_objects))
+    
+    def difference_many(self, csg_objects):
+        """Return the difference object of self and all the csg_objects.
+        
+        Objects not overlapping self are ignored, the others are merged
+        as in union_many into a single tool, removed from self with a
+        single difference operation.
+        Attributes such as creation position, material, color are taken
+        from the self object.
+        
+        """
+        
+        # Pending operations are not evaluated, their bounds are estimated
+        csg_objects = list(csg_objects)
+        bounds = _estimated_bounds([self] + csg_objects)
+        tools = [csg_object for csg_object, (bounding_box, _)
+                 in zip(csg_objects, bounds[1:])
+                 if _bounding_boxes_overlap(bounds[0][0], bounding_box)]
+        if not tools:
+            return copy.copy(self)
+        return self.difference(_merge_objects(tools))
+        
+    def evaluate(self):
+        """Evaluate the pending operations the object depends on.
+        
+        This is only meaningful when lazy_evaluation is enabled, the
+        geometry is evaluated anyway as soon as it is needed.
+        
+        """
+        
+        self._polyhedron
+        
+    def contains(self, points):
+        """Return the boolean mask of the (N, 3) points inside the object.
+        
+        Points are tested by the parity of the crossings of rays with the
+        surface, which must be closed. The triangles are indexed by a
+        bounding volume hierarchy in local space coordinates, built once
+        and shared by copies and instances, so transforming the object
+        does not require rebuilding it.
+        
+        """
+        
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        geometry = self._shared_geometry
+        if self._bvh is None or self._bvh.geometry is not geometry:
+            polyhedron = self._polyhedron
+            self._bvh = _BVH(geometry, polyhedron.get_vertices()[
+                                            polyhedron.get_triangles()])
+        inverse = numpy.linalg.inv(self.global_transform)
+        return self._bvh.contains(_transform_points(points, inverse))
+        
+    def _boolean(self, operator_, csg_object):
+        # Make a new object applying the polyhedron operator to self and
+        # csg_object. With lazy evaluation the operation is only recorded
+        # in the expression graph, with snapshots of the operands so that
+        # later changes to them do not affect the result.
+        # The resulting polyhedron is in global space coordinates, so the
+        # new object has the identity transform.
+        
+        if lazy_evaluation:
+            operation = _CSGOperation(operator_, copy.copy(self),
+                                      copy.copy(csg_object))
+        else:
+            operation = _CSGOperation(operator_, self, csg_object)
+            operation.evaluate()
+        new_object = CSGObject(self.pos, None, self.mat, self.color)
+        new_object._operation = operation
+        return new_object
     
     def __add__(self, other):
         """Perform union of CSGObjects.
@@ -200,176 +1408,2124 @@ class CSGObject(object):
     def __sub__(self, other):
         """Perform difference of CSGObjects.
         
-        Attributes such as creation position, material, color are taken
-        from the first object.
+        Attributes such as creation position, material, color are taken
+        from the first object.
+        
+        """
+        
+        return self.difference(other)
+    
+    def __mul__(self, other):
+        """Perform intersection of CSGObjects.
+        
+        Attributes such as creation position, material, color are taken
+        from the first object.
+        
+        """
+        
+        return self.intersection(other)
+    
+    def __xor__(self, other):
+        """Perform symmetric_difference of CSGObjects.
+        
+        Attributes such as creation position, material, color are taken
+        from the first object.
+        
+        """
+        
+        return self.symmetric_difference(other)
+    
+    def __copy__(self):
+        
+        # The copy does not belong to the group of the object, so it
+        # takes the global transform to keep the same placement
+        new_object = CSGObject(copy.copy(self._pos),
+                               self._local_polyhedron,
+                               self.mat,
+                               copy.copy(self.color),
+                               self.global_transform)
+        
+        # Share the pending operation without evaluating it
+        new_object._operation = self._operation
+        new_object._local_digest = self._local_digest
+        new_object._bvh = self._bvh
+        return new_object
+    
+    def export(self, filename, **keywords):
+        """Export the CSGObject of file.
+        
+        The xml format stores the material, color, geometry and
+        transform. The binary .stl, .ply and .npz formats store the
+        geometry in global space coordinates with a material id per
+        triangle, see export_mesh.
+        Nothing is written in preview quality.
+        
+        """
+        
+        if filename.endswith((".stl", ".ply", ".npz")):
+            export_mesh([self], filename, **keywords)
+        elif filename.endswith(".xml"):
+            if _skip_export(filename):
+                return
+            root_element = Et.Element("py_csg_script_data")
+            mesh_filename = filename[:-4]
+            if "mesh_format" in keywords.keys():
+                mesh_filename += keywords["mesh_format"]
+            else:
+                mesh_filename += ".obj"
+            _kernel().save(self._polyhedron, mesh_filename)
+            obj_element = self._make_xml_element(mesh_filename)
+            root_element.append(obj_element)
+            el_tree = Et.ElementTree(root_element)
+            el_tree.write(filename)
+    
+    def import_(self, filename, mmap = False):
+        """Import the CSGObject from file.
+        
+        The xml format sets the material, color, geometry and transform.
+        The .obj, .stl and .ply formats only set the geometry, see
+        import_mesh for the mmap argument.
+        
+        """
+        
+        if filename.endswith(_mesh_readers):
+            self._polyhedron = _load_polyhedron(filename, mmap)
+        elif filename.endswith(".xml"):
+            e_tree = Et.parse(filename)
+            obj_element = e_tree.getroot().find("csg_obj")
+            if obj_element is None:
+                return
+            else:
+                mesh_filename = obj_element.get("filename")
+                
+                # Load into a new polyhedron, the current one may be
+                # shared with copies or cached
+                self._polyhedron = _load_polyhedron(mesh_filename, mmap)
+                
+                self.color = _parse_color(obj_element.get("color"))
+                self.mat = obj_element.get("mat")
+                self.transform = _parse_transform(obj_element.find("transform"))
+                    
+    def _make_xml_element(self, filename):
+        # Make an xml element that stores the color, mat and
+        # the filename of the mesh
+        
+        e = Et.Element("csg_obj", filename = filename)
+        
+        r = int(self.color[0] * 255.0) 
+        g = int(self.color[1] * 255.0)
+        b = int(self.color[2] * 255.0) 
+        a = int(self.color[3] * 255.0)
+        color_string = "#{0:02X}{1:02X}{2:02X}{3:02X}".format(r, g, b, a)
+        
+        transform_e = Et.Element("transform")
+        for row in self.global_transform.tolist():
+            row_e = Et.Element("row")
+            transform_e.append(row_e)
+            for element in row:
+                el_e = Et.Element("element")
+                el_e.text = repr(element)
+                row_e.append(el_e)
+                
+        e.set("color", color_string)
+        e.set("mat", self.mat)
+        e.append(transform_e)
+        return e
+    
+    
+def iter_import(filename, max_workers = None, mmap = False):
+    """Import all the CSGObjects of an xml file, yielding them in order.
+    
+    The file is parsed incrementally and the elements are discarded once
+    read, so the memory used does not depend on the size of the file.
+    The meshes are loaded in a pool of max_workers threads (by default
+    the number of processors), a bounded number of objects ahead of the
+    one being yielded. The threads overlap the reading of the files, but
+    parsing and the kernel mostly hold the interpreter lock, so loading
+    does not use all the processors at once. Objects referencing the
+    same mesh file share the polyhedron, which is only kept while any
+    of them is pending or in use. See import_mesh for the mmap argument.
+    
+    """
+    
+    import multiprocessing
+    
+    max_workers = max_workers or multiprocessing.cpu_count()
+    
+    # The [future, count] of the polyhedron of each mesh file referenced
+    # by count pending objects, and the loaded polyhedra still in use
+    polyhedra = {}
+    loaded = weakref.WeakValueDictionary()
+    
+    pending = collections.deque()
+    if futures is None:
+        executor = _SerialExecutor()
+    else:
+        executor = futures.ThreadPoolExecutor(max_workers)
+    with executor:
+        context = Et.iterparse(filename, events=("start", "end"))
+        _, root_element = next(context)
+        for event, element in context:
+            if event != "end" or element.tag != "csg_obj":
+                continue
+            mesh_filename = element.get("filename")
+            if mesh_filename not in polyhedra:
+                polyhedron = loaded.get(mesh_filename)
+                if polyhedron is None:
+                    future = executor.submit(_load_polyhedron, mesh_filename,
+                                             mmap)
+                else:
+                    future = _CompletedTask(polyhedron)
+                polyhedra[mesh_filename] = [future, 0]
+            polyhedra[mesh_filename][1] += 1
+            pending.append((polyhedra[mesh_filename][0],
+                            mesh_filename,
+                            element.get("mat"),
+                            _parse_color(element.get("color")),
+                            _parse_transform(element.find("transform"))))
+            root_element.clear()
+            
+            while (len(pending) > 2 * max_workers or
+                   (pending and pending[0][0].done())):
+                yield _imported_object(polyhedra, loaded,
+                                       *pending.popleft())
+        while pending:
+            yield _imported_object(polyhedra, loaded, *pending.popleft())
+            
+            
+def _imported_object(polyhedra, loaded, future, mesh_filename, mat, color,
+                     transform):
+    # Make a CSGObject when its polyhedron is loaded. The polyhedron is
+    # only referenced weakly once no other pending object needs it,
+    # polyhedra not supporting weak references are not shared further.
+    
+    polyhedron = future.result()
+    entry = polyhedra[mesh_filename]
+    entry[1] -= 1
+    if not entry[1]:
+        del polyhedra[mesh_filename]
+        try:
+            loaded[mesh_filename] = polyhedron
+        except TypeError:
+            pass
+    return CSGObject(polyhedron=polyhedron, mat=mat, color=color,
+                     transform=transform)
+
+
+class _CompletedTask(object):
+    # A task already run, with the done and result methods of a future
+    
+    def __init__(self, result):
+        self._result = result
+        
+    def done(self):
+        return True
+    
+    def result(self):
+        return self._result
+    
+    
+class _SerialExecutor(object):
+    # An executor running each task as soon as it is submitted, in place
+    # of the pools of concurrent.futures when it is not available
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        pass
+    
+    def submit(self, function, *args):
+        return _CompletedTask(function(*args))
+    
+    
+def _load_polyhedron(mesh_filename, mmap = False):
+    # Load a new polyhedron from a mesh file. The file is parsed with
+    # NumPy if the kernel builds polyhedra from arrays natively or cannot
+    # read the format, otherwise the kernel loads it.
+    
+    kernel = _kernel()
+    if (mesh_filename.endswith(_mesh_readers) and
+            (kernel.native_arrays or
+             not mesh_filename.endswith(kernel.native_formats))):
+        return _polyhedron_from_arrays(*_read_mesh_arrays(mesh_filename,
+                                                          mmap))
+    return kernel.load(mesh_filename)
+        
+        
+def _parse_color(color_string):
+    # Parse the #RRGGBBAA color string of an xml element
+    
+    return tuple(int(color_string[i:i + 2], 16) / 255.0
+                 for i in range(1, 9, 2))
+
+
+def _parse_transform(transform_e):
+    # Parse the transform matrix of an xml element
+    
+    return [[float(el_e.text) for el_e in list(row_e)]
+            for row_e in list(transform_e)]
+
+
+def union_all(csg_objects):
+    """Return the union of all the csg_objects.
+    
+    The union is performed as a balanced tree of operations between
+    objects of similar size that are close to each other, instead of
+    adding the objects one by one to an ever growing object.
+    Attributes such as creation position, material, color are taken
+    from the first object.
+    
+    """
+    
+    return _balanced_reduce(operator.add, csg_objects)
+
+
+def intersection_all(csg_objects):
+    """Return the intersection of all the csg_objects.
+    
+    The intersection is performed as a balanced tree of operations, see
+    union_all.
+    Attributes such as creation position, material, color are taken
+    from the first object.
+    
+    """
+    
+    return _balanced_reduce(operator.mul, csg_objects)
+
+
+def _balanced_reduce(operator_, csg_objects):
+    # Reduce the objects with the operator in a balanced tree.
+    # The objects are split recursively along the widest axis of their
+    # centers, at the point where both halves have about the same
+    # number of vertices. The first object is always kept as the
+    # leftmost leaf so that the result takes its attributes.
+    
+    objects = list(csg_objects)
+    if not objects:
+        raise ValueError("At least one CSGObject is required")
+    elif len(objects) == 1:
+        return copy.copy(objects[0])
+    
+    # Pending operations are not evaluated, their bounds are estimated
+    centers = numpy.zeros((len(objects), 3))
+    sizes = numpy.zeros(len(objects))
+    for i, (bounding_box, size) in enumerate(_estimated_bounds(objects)):
+        if bounding_box is not None:
+            centers[i] = (bounding_box[0] + bounding_box[1]) / 2.0
+            sizes[i] = size
+    
+    def reduce_(indices):
+        if len(indices) == 1:
+            return objects[indices[0]]
+        
+        indices_centers = centers[indices]
+        extent = indices_centers.max(axis=0) - indices_centers.min(axis=0)
+        order = numpy.argsort(indices_centers[:, extent.argmax()],
+                              kind="mergesort")
+        indices = indices[order]
+        cumulative_sizes = numpy.cumsum(sizes[indices])
+        split = numpy.searchsorted(cumulative_sizes,
+                                   cumulative_sizes[-1] / 2.0) + 1
+        split = min(max(split, 1), len(indices) - 1)
+        left, right = indices[:split], indices[split:]
+        if 0 in right:
+            left, right = right, left
+        return reduce_(left)._boolean(operator_, reduce_(right))
+    
+    return reduce_(numpy.arange(len(objects)))
+
+
+def _estimated_bounds(csg_objects):
+    # Return the (bounding box, vertex count) pair of each of the
+    # csg_objects without evaluating pending operations. The box of a
+    # pending operation is derived from the boxes of its operands, so it
+    # contains the actual one, and its vertex count is the sum of the
+    # counts of the operands. Evaluated objects give the exact values.
+    
+    estimates = {}
+    
+    def estimate(csg_object):
+        operation = csg_object._operation
+        if operation is None or operation.polyhedron is not None:
+            return (csg_object.bounding_box,
+                    len(csg_object._polyhedron.get_vertices()))
+        bounding_box, size = estimates[id(operation)]
+        global_transform = csg_object.global_transform
+        if bounding_box is None or _is_identity(global_transform):
+            return bounding_box, size
+        corners = _transform_points(
+                numpy.array(list(itertools.product(*zip(*bounding_box)))),
+                global_transform)
+        return (corners.min(axis=0), corners.max(axis=0)), size
+    
+    # Estimate the pending operations in post-order with an explicit
+    # stack, as _CSGOperation.evaluate does
+    visited = set([])
+    stack = [(csg_object._operation, False) for csg_object in csg_objects]
+    while stack:
+        operation, expanded = stack.pop()
+        if operation is None or operation.polyhedron is not None:
+            continue
+        if expanded:
+            first, second = [estimate(operand)
+                             for operand in operation.operands]
+            estimates[id(operation)] = (
+                    _combined_bounding_box(operation.operator, first[0],
+                                           second[0]),
+                    first[1] + second[1])
+        elif id(operation) not in visited:
+            visited.add(id(operation))
+            stack.append((operation, True))
+            stack.extend((operand._operation, False)
+                         for operand in operation.operands)
+    
+    return [estimate(csg_object) for csg_object in csg_objects]
+
+
+def _combined_bounding_box(operator_, first, second):
+    # A box containing the result of the polyhedron operator applied to
+    # objects with the first and second bounding boxes
+    
+    if operator_ is operator.sub:
+        return first
+    elif operator_ is operator.mul:
+        if not _bounding_boxes_overlap(first, second):
+            return None
+        return numpy.maximum(first[0], second[0]), \
+               numpy.minimum(first[1], second[1])
+    elif first is None:
+        return second
+    elif second is None:
+        return first
+    return numpy.minimum(first[0], second[0]), \
+           numpy.maximum(first[1], second[1])
+
+
+def evaluate_parallel(csg_objects, max_workers = None):
+    """Evaluate the pending operations of the csg_objects in parallel.
+    
+    The independent operations of the expression graphs built with
+    lazy_evaluation enabled are run in the pool of processes started by
+    start_process_pool, with max_workers processes (by default the number
+    of processors) if it is not started yet. An operation is started as
+    soon as the operations it depends on are done. Polyhedra are passed
+    to the processes as arrays, or as files in the exchange format of
+    kernels that cannot build polyhedra from arrays natively.
+    Objects without pending operations are left untouched.
+    
+    """
+    
+    # Collect the pending operations, and for each one the number of
+    # pending operations it depends on and the operations depending on it
+    operations = []
+    waiting = {}
+    dependents = {}
+    visited = set([])
+    stack = [csg_object._operation for csg_object in csg_objects
+             if csg_object._operation is not None]
+    while stack:
+        operation = stack.pop()
+        if operation.polyhedron is not None or id(operation) in visited:
+            continue
+        visited.add(id(operation))
+        operations.append(operation)
+        waiting[id(operation)] = 0
+        for operand in operation.operands:
+            child = operand._operation
+            if child is not None and child.polyhedron is None:
+                waiting[id(operation)] += 1
+                dependents.setdefault(id(child), []).append(operation)
+                stack.append(child)
+    
+    # Not worth starting the processes for a single operation
+    if len(operations) < 2 or futures is None:
+        for operation in operations:
+            operation.evaluate()
+        return
+    
+    executor = start_process_pool(max_workers)
+    ready = [operation for operation in operations
+             if not waiting[id(operation)]]
+    running = {}
+    while ready or running:
+        done = []
+        for operation in ready:
+            if operation._lookup():
+                done.append(operation)
+            else:
+                first, second = operation.operands
+                future = executor.submit(_compute_operation, backend,
+                                operation.operator,
+                                _pack_polyhedron(first.global_polyhedron),
+                                _pack_polyhedron(second.global_polyhedron))
+                running[future] = operation
+        ready = []
+        
+        if running and not done:
+            finished, _ = futures.wait(running,
+                                       return_when=futures.FIRST_COMPLETED)
+            for future in finished:
+                operation = running.pop(future)
+                operation._store(_unpack_polyhedron(future.result()))
+                done.append(operation)
+        
+        # Start the operations whose operands are all evaluated
+        for operation in done:
+            for dependent in dependents.get(id(operation), []):
+                waiting[id(dependent)] -= 1
+                if not waiting[id(dependent)]:
+                    ready.append(dependent)
+
+
+# The (max_workers, executor) pair of the process pool of
+# evaluate_parallel, None until started
+_process_pool = None
+
+
+def start_process_pool(max_workers = None):
+    """Start the pool of max_workers processes (by default the number of \
+    processors) used by evaluate_parallel and voxelize and return it.
+    
+    The pool is kept for the following calls, unless a different
+    max_workers is requested. Return None if concurrent.futures is not
+    available. Forking a process from a secondary thread
+    of a GUI application is unsafe: where available, processes are
+    spawned if the pool is started outside the main thread, and then
+    only the kernels registered on import are available. Otherwise call
+    this function from the main thread first, the processes are started
+    right away.
+    
+    """
+    
+    import multiprocessing
+    import threading
+    
+    global _process_pool
+    if futures is None:
+        return None
+    max_workers = max_workers or multiprocessing.cpu_count()
+    if _process_pool is not None:
+        if _process_pool[0] == max_workers:
+            return _process_pool[1]
+        _process_pool[1].shutdown()
+        _process_pool = None
+    
+    executor = None
+    main_thread = getattr(threading, "main_thread", None)
+    if (main_thread is not None and
+            threading.current_thread() is not main_thread()):
+        try:
+            executor = futures.ProcessPoolExecutor(max_workers,
+                            mp_context=multiprocessing.get_context("spawn"))
+        except TypeError:
+            pass
+    if executor is None:
+        executor = futures.ProcessPoolExecutor(max_workers)
+        
+    # Start the processes now rather than on the first operation
+    list(executor.map(abs, range(max_workers)))
+    _process_pool = (max_workers, executor)
+    return executor
+
+
+def _pack_polyhedron(polyhedron):
+    # Make a picklable representation of a polyhedron, to move it between
+    # processes: its arrays, or a temporary file in the exchange format
+    # if the kernel cannot build polyhedra from arrays natively
+    
+    if _kernel().native_arrays:
+        return polyhedron.get_vertices(), polyhedron.get_triangles()
+    return _save_temporary(polyhedron)
+
+
+def _unpack_polyhedron(packed):
+    # The polyhedron of a representation made by _pack_polyhedron, the
+    # temporary file is removed
+    
+    if isinstance(packed, tuple):
+        return _polyhedron_from_arrays(*packed)
+    try:
+        return _kernel().load(packed)
+    finally:
+        os.remove(packed)
+
+
+def _compute_operation(backend_name, operator_, first, second):
+    # Compute an operation between two polyhedra packed in global space
+    # coordinates with the named kernel, and return the packed result.
+    # This is run by the worker processes of evaluate_parallel.
+    
+    global backend
+    backend = backend_name
+    first = CSGObject(polyhedron=_unpack_polyhedron(first))
+    second = CSGObject(polyhedron=_unpack_polyhedron(second))
+    operation = _CSGOperation(operator_, first, second)
+    return _pack_polyhedron(operation._compute(first, second))
+
+
+
+def transform_all(csg_objects, transforms):
+    """Apply a transform to each of the csg_objects at once.
+    
+    transforms is a (N, 4, 4) array with a transform for each of the
+    N objects, or a single 4x4 transform applied to all of them. Each
+    transform is composed in global space coordinates, as translate,
+    rotate and scale do.
+    
+    """
+    
+    csg_objects = list(csg_objects)
+    if not csg_objects:
+        return
+    current = numpy.array([csg_object.transform
+                           for csg_object in csg_objects])
+    transforms = numpy.broadcast_to(numpy.asarray(transforms,
+                                                  dtype=numpy.float64),
+                                    current.shape)
+    composed = numpy.einsum("nij,njk->nik", transforms, current)
+    for csg_object, transform in zip(csg_objects, composed):
+        csg_object._transform = transform
+        csg_object._invalidate_global_cache()
+
+
+def translation_matrices(offsets):
+    """Return a (N, 4, 4) array of translation matrices from a (N, 3) \
+    array of offsets, to be used with transform_all."""
+    
+    offsets = numpy.asarray(offsets, dtype=numpy.float64)
+    matrices = numpy.zeros((len(offsets), 4, 4))
+    matrices[:] = numpy.identity(4)
+    matrices[:, :3, 3] = offsets
+    return matrices
+
+
+def linear_array(csg_object, counts, pitch):
+    """Return a single object made of copies of csg_object placed on a \
+    regular grid.
+    
+    counts is the number of copies along each direction of the grid,
+    either an int or a sequence of up to three ints. pitch is the step
+    vector of each direction, or the spacing along the x, y and z axes
+    in turn, as a sequence with a value for each direction or a single
+    value for all of them. For a single direction a sequence of three
+    values is its step vector.
+    The copies are merged without boolean processing unless they
+    overlap, so the result can be used as a tool to cut a pattern of
+    features with a single difference.
+    Attributes such as creation position, material, color are taken
+    from csg_object.
+    
+    """
+    
+    if isinstance(counts, int):
+        counts = (counts,)
+    pitch = numpy.asarray(pitch, dtype=numpy.float64)
+    if pitch.ndim == 0:
+        pitch = numpy.repeat(pitch, len(counts))
+    if pitch.ndim == 1 and len(counts) == 1 and len(pitch) == 3:
+        pitch = pitch[None, :]
+    elif pitch.ndim == 1 and len(pitch) <= 3:
+        pitch = numpy.identity(3)[:len(pitch)] * pitch[:, None]
+    if pitch.shape != (len(counts), 3):
+        raise ValueError("pitch must give a spacing or a step vector for "
+                         "each of the counts")
+    
+    grid = numpy.indices(counts).reshape(len(counts), -1).T
+    return _pattern(csg_object, translation_matrices(grid.dot(pitch)))
+
+
+def polar_array(csg_object, count, axis, origin, angle = 360.0):
+    """Return a single object made of count copies of csg_object \
+    rotated around the axis starting at origin.
+    
+    The copies are evenly spaced on a full turn, or span angle degrees
+    if a partial angle is given. As for linear_array, the copies are
+    merged without boolean processing unless they overlap.
+    Attributes such as creation position, material, color are taken
+    from csg_object.
+    
+    """
+    
+    if abs(angle) >= 360.0:
+        angles = numpy.linspace(0.0, angle, count, endpoint=False)
+    else:
+        angles = numpy.linspace(0.0, angle, count)
+    transforms = numpy.array([_rotation_matrix(axis, origin, a)
+                              for a in angles])
+    return _pattern(csg_object, transforms)
+
+
+def _pattern(csg_object, transforms):
+    # Return the object made of the copies of csg_object with each of the
+    # (K, 4, 4) transforms applied in global space coordinates. Disjoint
+    # copies are concatenated in a single mesh, overlapping copies are
+    # united.
+    
+    polyhedron = csg_object._polyhedron
+    local_vertices = polyhedron.get_vertices()
+    local_triangles = polyhedron.get_triangles()
+    
+    # Instances compose the transforms with the one of csg_object
+    # themselves, the vertices need the composed ones
+    global_transforms = numpy.einsum("kij,jl->kil", transforms,
+                                     csg_object.global_transform)
+    vertices = (numpy.einsum("kij,nj->kni", global_transforms[:, :3, :3],
+                             local_vertices) +
+                global_transforms[:, None, :3, 3])
+    
+    if len(local_vertices) and len(_overlapping_pairs(vertices.min(axis=1),
+                                                      vertices.max(axis=1))):
+        return union_all([Instance(csg_object, transform)
+                          for transform in transforms])
+    
+    # The copies are built with a single call to the kernel, which for
+    # kernels without native array construction is a single file
+    offsets = numpy.arange(len(transforms)) * len(local_vertices)
+    triangles = local_triangles[None, :, :] + offsets[:, None, None]
+    polyhedron = _polyhedron_from_arrays(vertices.reshape(-1, 3),
+                                         triangles.reshape(-1, 3))
+    return CSGObject(csg_object.pos, polyhedron, csg_object.mat,
+                     csg_object.color)
+
+
+def _overlapping_pairs(mins, maxs):
+    # Return the (P, 2) array of the index pairs (i < j) of overlapping
+    # bounding boxes, given the (K, 3) arrays of their minimum and maximum
+    # corners. Boxes are compared in chunks to bound the memory used.
+    
+    chunk = 512
+    pairs = [numpy.zeros((0, 2), dtype=numpy.intp)]
+    for start in range(0, len(mins), chunk):
+        overlap = numpy.all((mins[start:start + chunk, None] <= maxs) &
+                            (mins <= maxs[start:start + chunk, None]),
+                            axis=2)
+        rows, columns = numpy.nonzero(overlap)
+        rows += start
+        pairs.append(numpy.column_stack((rows, columns))[rows < columns])
+    return numpy.vstack(pairs)
+
+
+def _merge_objects(csg_objects):
+    # Return a single object with the volume of all the csg_objects.
+    # Empty objects are left out. Attributes are taken from the first
+    # object even if it is empty, if all are empty it is copied.
+    
+    first = csg_objects[0]
+    
+    # Pending operations are not evaluated, their bounds are estimated
+    bounding_boxes = [bounding_box for bounding_box, _
+                      in _estimated_bounds(csg_objects)]
+    csg_objects = [csg_object for csg_object, bounding_box
+                   in zip(csg_objects, bounding_boxes)
+                   if bounding_box is not None]
+    bounding_boxes = [bounding_box for bounding_box in bounding_boxes
+                      if bounding_box is not None]
+    if not csg_objects:
+        return copy.copy(first)
+    elif len(csg_objects) == 1:
+        merged = copy.copy(csg_objects[0])
+    else:
+        merged = _merge_clusters(csg_objects, bounding_boxes)
+    
+    merged._pos = first.pos
+    merged.mat = first.mat
+    merged.color = first.color
+    return merged
+
+
+def _merge_clusters(csg_objects, bounding_boxes):
+    # Return a single object with the volume of all the non empty
+    # csg_objects, given their bounding boxes. Objects whose bounding
+    # boxes overlap, directly or through other objects, are united; the
+    # resulting clusters are disjoint and are concatenated without
+    # boolean processing.
+    
+    mins = numpy.array([bounding_box[0] for bounding_box in bounding_boxes])
+    maxs = numpy.array([bounding_box[1] for bounding_box in bounding_boxes])
+    
+    # Connected components of the overlap graph, with union-find
+    labels = list(range(len(csg_objects)))
+    def find(i):
+        while labels[i] != i:
+            labels[i] = labels[labels[i]]
+            i = labels[i]
+        return i
+    for i, j in _overlapping_pairs(mins, maxs):
+        root_i, root_j = find(i), find(j)
+        if root_i != root_j:
+            labels[max(root_i, root_j)] = min(root_i, root_j)
+    
+    clusters = collections.OrderedDict()
+    for i, csg_object in enumerate(csg_objects):
+        clusters.setdefault(find(i), []).append(csg_object)
+    merged = [_balanced_reduce(operator.add, cluster)
+              for cluster in clusters.values()]
+    if len(merged) == 1:
+        return merged[0]
+    
+    # With lazy evaluation and native array construction the clusters
+    # are united by pending operations, which concatenate disjoint
+    # operands when evaluated. Otherwise the pending clusters are
+    # evaluated and all of them are concatenated with a single call to
+    # the kernel.
+    if lazy_evaluation:
+        if _kernel().native_arrays:
+            return _balanced_reduce(operator.add, merged)
+        evaluate_parallel(merged)
+    polyhedron = _concatenate_polyhedra([csg_object.global_polyhedron
+                                         for csg_object in merged])
+    return CSGObject(polyhedron=polyhedron)
+
+
+def _skip_export(filename):
+    # Exports are skipped in preview quality, so that the runs of the
+    # editor while typing never overwrite a file with coarse geometry
+    
+    if quality == "final":
+        return False
+    warnings.warn("Export of {0} skipped in {1} quality".format(filename,
+                                                                quality))
+    return True
+
+
+def export_mesh(csg_objects, filename, material_ids = None):
+    """Export the geometry of the csg_objects to a single mesh file.
+    
+    The format is chosen by the extension: binary STL (.stl), binary
+    little endian PLY (.ply) or NumPy (.npz). Vertices are in global
+    space coordinates. Each triangle is tagged with the id of the
+    material of its object, taken from the material_ids dictionary, or
+    else numbered from 1 in order of appearance, as voxelize does. STL
+    stores the id in the 16 bit attribute field of each triangle, PLY in
+    a material face property, and npz in a material_ids array along with
+    the materials names, both 32 bit signed integers. A ValueError is
+    raised for ids out of the range of the format.
+    STL and PLY files are written one object at a time.
+    Nothing is written in preview quality.
+    
+    """
+    
+    if _skip_export(filename):
+        return
+    csg_objects = list(csg_objects)
+    material_ids = _number_materials(csg_objects, material_ids)[0]
+    if filename.endswith(".stl"):
+        id_range = (0, 0xffff)
+    else:
+        id_range = (-0x80000000, 0x7fffffff)
+    for csg_object in csg_objects:
+        id_ = material_ids[csg_object.mat]
+        if not id_range[0] <= id_ <= id_range[1]:
+            raise ValueError("Material id {0} of {1!r} out of the range "
+                             "of {2}".format(id_, csg_object.mat, filename))
+            
+    # The meshes are transformed one at a time while writing, without
+    # baking the global polyhedra of the objects
+    meshes = [csg_object._global_mesh() + (material_ids[csg_object.mat],)
+              for csg_object in csg_objects]
+    if filename.endswith(".stl"):
+        _write_stl(meshes, filename)
+    elif filename.endswith(".ply"):
+        _write_ply(meshes, filename)
+    elif filename.endswith(".npz"):
+        _write_npz(meshes, filename, material_ids)
+    else:
+        raise ValueError("Unsupported mesh format: " + filename)
+
+
+_stl_dtype = numpy.dtype([("normal", "<f4", (3,)),
+                          ("vertices", "<f4", (3, 3)),
+                          ("attribute", "<u2")])
+
+_ply_face_dtype = numpy.dtype([("count", "u1"),
+                               ("indices", "<i4", (3,)),
+                               ("material", "<i4")])
+
+
+def _write_stl(meshes, filename):
+    # Write a binary STL file of the (polyhedron, transform, material id)
+    # meshes, see _mesh_arrays. The number of triangles in the header is
+    # written once all the meshes have been written.
+    
+    count = 0
+    with open(filename, "wb") as f:
+        f.write(b"pyCSGScript".ljust(80, b" "))
+        f.write(numpy.array([0], dtype="<u4").tobytes())
+        for polyhedron, transform, id_ in meshes:
+            vertices, triangles = _mesh_arrays(polyhedron, transform)
+            corners = vertices[triangles]
+            normals = numpy.cross(corners[:, 1] - corners[:, 0],
+                                  corners[:, 2] - corners[:, 0])
+            lengths = numpy.sqrt((normals * normals).sum(axis=1))
+            lengths[lengths == 0.0] = 1.0
+            
+            records = numpy.empty(len(triangles), dtype=_stl_dtype)
+            records["normal"] = normals / lengths[:, None]
+            records["vertices"] = corners
+            records["attribute"] = id_
+            f.write(records.tobytes())
+            count += len(triangles)
+        f.seek(80)
+        f.write(numpy.array([count], dtype="<u4").tobytes())
+        
+        
+def _write_ply(meshes, filename):
+    # Write a binary little endian PLY file of the (polyhedron, transform,
+    # material id) meshes, see _mesh_arrays. The header needs the totals,
+    # so the sizes of the meshes are counted first.
+    
+    vertex_count = 0
+    face_count = 0
+    for polyhedron, transform, id_ in meshes:
+        vertex_count += len(polyhedron.get_vertices())
+        face_count += len(polyhedron.get_triangles())
+    
+    header = ("ply\n"
+              "format binary_little_endian 1.0\n"
+              "comment pyCSGScript\n"
+              "element vertex {0}\n"
+              "property double x\n"
+              "property double y\n"
+              "property double z\n"
+              "element face {1}\n"
+              "property list uchar int vertex_indices\n"
+              "property int material\n"
+              "end_header\n").format(vertex_count, face_count)
+    
+    with open(filename, "wb") as f:
+        f.write(header.encode("ascii"))
+        for polyhedron, transform, id_ in meshes:
+            vertices = _mesh_arrays(polyhedron, transform)[0]
+            f.write(numpy.ascontiguousarray(vertices, "<f8").tobytes())
+        offset = 0
+        for polyhedron, transform, id_ in meshes:
+            triangles = polyhedron.get_triangles()
+            if (transform is not None and
+                    numpy.linalg.det(transform[:3, :3]) < 0.0):
+                triangles = triangles[:, ::-1]
+            records = numpy.empty(len(triangles), dtype=_ply_face_dtype)
+            records["count"] = 3
+            records["indices"] = triangles + offset
+            records["material"] = id_
+            f.write(records.tobytes())
+            offset += len(polyhedron.get_vertices())
+            
+            
+def _write_npz(meshes, filename, material_ids):
+    # Write a NumPy .npz file of the (polyhedron, transform, material id)
+    # meshes, see _mesh_arrays, with the names of the material_ids. The
+    # arrays of all the meshes are joined.
+    
+    vertices = [numpy.zeros((0, 3))]
+    triangles = [numpy.zeros((0, 3), dtype=numpy.int64)]
+    materials = [numpy.zeros(0, dtype=numpy.int32)]
+    offset = 0
+    for polyhedron, transform, id_ in meshes:
+        mesh_vertices, mesh_triangles = _mesh_arrays(polyhedron, transform)
+        vertices.append(mesh_vertices)
+        triangles.append(mesh_triangles + offset)
+        materials.append(numpy.repeat(numpy.int32(id_), len(mesh_triangles)))
+        offset += len(vertices[-1])
+    
+    names = sorted(material_ids, key=material_ids.get)
+    numpy.savez(filename,
+                vertices=numpy.vstack(vertices),
+                triangles=numpy.vstack(triangles),
+                material_ids=numpy.concatenate(materials),
+                materials=numpy.array(names),
+                material_numbers=numpy.array([material_ids[name]
+                                              for name in names]))
+
+
+
+
+def export_scene(csg_objects, filename):
+    """Export all the csg_objects into a single scene file.
+    
+    The csg_objects are either a dictionary, such as the namespace of a
+    script, whose keys name the objects, or a sequence. The file is a
+    zip archive holding a scene.xml with the name, material, color,
+    transform and mesh of each object, and each distinct mesh stored
+    once, so copies and instances share their geometry. Meshes are
+    stored as NumPy arrays, or in the exchange format of kernels that
+    cannot build polyhedra from arrays natively, and are identified by
+    their content hash. Nothing is written in preview quality.
+    
+    """
+    
+    if _skip_export(filename):
+        return
+    if isinstance(csg_objects, dict):
+        items = sorted(csg_objects.items())
+    else:
+        items = [("object_{0}".format(i), csg_object)
+                 for i, csg_object in enumerate(csg_objects)]
+    
+    # Keep a single entry for object, as in the namespace of a script an
+    # object may have many names
+    processed_objects = set([])
+    scene_objects = []
+    for name, csg_object in items:
+        if (isinstance(csg_object, CSGObject) and
+                csg_object not in processed_objects):
+            processed_objects.add(csg_object)
+            scene_objects.append((name, csg_object))
+    evaluate_parallel([csg_object for name, csg_object in scene_objects])
+    
+    kernel = _kernel()
+    root_element = Et.Element("py_csg_script_data")
+    written_meshes = set([])
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_STORED,
+                         allowZip64=True) as archive:
+        for name, csg_object in scene_objects:
+            digest = csg_object._digest()
+            mesh_filename = "meshes/" + digest
+            if not kernel.native_arrays:
+                mesh_filename += kernel.exchange_format
+            if digest not in written_meshes:
+                written_meshes.add(digest)
+                polyhedron = csg_object._polyhedron
+                if kernel.native_arrays:
+                    _write_zip_array(archive,
+                                     mesh_filename + "/vertices.npy",
+                                     polyhedron.get_vertices())
+                    _write_zip_array(archive,
+                                     mesh_filename + "/triangles.npy",
+                                     polyhedron.get_triangles())
+                else:
+                    temp_filename = _save_temporary(polyhedron)
+                    try:
+                        archive.write(temp_filename, mesh_filename)
+                    finally:
+                        os.remove(temp_filename)
+            obj_element = csg_object._make_xml_element(mesh_filename)
+            obj_element.set("name", name)
+            root_element.append(obj_element)
+        archive.writestr("scene.xml", Et.tostring(root_element))
+        
+        
+def import_scene(filename):
+    """Import the objects of a scene file written by export_scene.
+    
+    Return a dictionary of the CSGObjects by name. Objects that were
+    exported with the same mesh share it.
+    
+    """
+    
+    csg_objects = {}
+    polyhedra = {}
+    with zipfile.ZipFile(filename, "r") as archive:
+        root_element = Et.fromstring(archive.read("scene.xml"))
+        names = set(archive.namelist())
+        for obj_element in root_element.iter("csg_obj"):
+            mesh_filename = obj_element.get("filename")
+            if mesh_filename not in polyhedra:
+                if mesh_filename in names:
+                    polyhedra[mesh_filename] = _load_zip_mesh(archive,
+                                                              mesh_filename)
+                else:
+                    vertices = _read_zip_array(archive,
+                                               mesh_filename + "/vertices.npy")
+                    triangles = _read_zip_array(archive,
+                                              mesh_filename + "/triangles.npy")
+                    polyhedra[mesh_filename] = _polyhedron_from_arrays(
+                                                        vertices, triangles)
+            csg_object = CSGObject(polyhedron=polyhedra[mesh_filename],
+                         mat=obj_element.get("mat"),
+                         color=_parse_color(obj_element.get("color")),
+                         transform=_parse_transform(
+                                            obj_element.find("transform")))
+            csg_object._local_digest = os.path.splitext(
+                                        mesh_filename[len("meshes/"):])[0]
+            csg_objects[obj_element.get("name")] = csg_object
+    return csg_objects
+
+
+def _write_zip_array(archive, name, array):
+    # Store an array in the .npy format into a zip archive
+    
+    buffer_ = io.BytesIO()
+    numpy.lib.format.write_array(buffer_, numpy.ascontiguousarray(array))
+    archive.writestr(name, buffer_.getvalue())
+    
+    
+def _read_zip_array(archive, name):
+    # Read an array in the .npy format from a zip archive
+    
+    return numpy.lib.format.read_array(io.BytesIO(archive.read(name)))
+
+
+def _load_zip_mesh(archive, name):
+    # Load a polyhedron from a mesh file of a zip archive, extracted to a
+    # temporary file for the kernel to read
+    
+    fd, filename = tempfile.mkstemp(suffix=os.path.splitext(name)[1])
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(archive.read(name))
+        return _kernel().load(filename)
+    finally:
+        os.remove(filename)
+
+
+def import_mesh(filename, mat = None, color = None, mmap = False):
+    """Import a CSGObject from an .obj, .stl or .ply mesh file.
+    
+    The files are parsed with NumPy and the polyhedron is built from the
+    arrays at once, unless the kernel cannot build polyhedra from arrays
+    natively and reads the format itself, as pyPolyCSG does for OBJ.
+    Both binary and ASCII STL and PLY are supported. If mmap is True the
+    records of binary files are memory mapped instead of read, lowering
+    the memory needed for large files.
+    
+    """
+    
+    if not filename.endswith(_mesh_readers):
+        raise ValueError("Unsupported mesh format: " + filename)
+    return CSGObject(polyhedron=_load_polyhedron(filename, mmap), mat=mat,
+                     color=color)
+
+
+def _read_mesh_arrays(filename, mmap = False):
+    # Read the (N, 3) array of vertices and the (M, 3) array of triangle
+    # indices of a mesh file
+    
+    for extension, reader in _mesh_readers_by_extension:
+        if filename.endswith(extension):
+            return reader(filename, mmap)
+    raise ValueError("Unsupported mesh format: " + filename)
+
+
+def _read_obj(filename, mmap):
+    # Read an OBJ file. Only the vertex positions and the faces are used,
+    # polygons are triangulated as fans.
+    
+    with open(filename, "rb") as f:
+        lines = f.read().splitlines()
+    
+    vertex_lines = [line[2:] for line in lines if line.startswith(b"v ")]
+    tokens = b" ".join(vertex_lines).split()
+    width = len(vertex_lines[0].split()) if vertex_lines else 0
+    if tokens and len(tokens) == len(vertex_lines) * width:
+        # All the lines have the same number of values, such as the
+        # optional w or the vertex colors
+        vertices = numpy.array(tokens, dtype=numpy.float64).reshape(
+                                                    len(vertex_lines), -1)
+    else:
+        vertices = numpy.array([line.split()[:3] for line in vertex_lines],
+                               dtype=numpy.float64).reshape(-1, 3)
+    
+    polygons = [line[2:].split() for line in lines if line.startswith(b"f ")]
+    triangles = _polygon_triangles(polygons)
+    
+    # OBJ indices start from 1, negative ones count from the end of the
+    # vertices
+    triangles[triangles < 0] += len(vertices) + 1
+    return vertices[:, :3], triangles - 1
+
+
+def _polygon_triangles(polygons):
+    # Triangulate as fans the polygons given as sequences of indices or
+    # of index tokens, processing together the polygons with the same
+    # number of vertices. The texture and normal indices of OBJ tokens
+    # are dropped.
+    
+    by_size = collections.defaultdict(list)
+    for polygon in polygons:
+        by_size[len(polygon)].append(polygon)
+    
+    triangles = [numpy.zeros((0, 3), dtype=numpy.int64)]
+    for size, same_size in sorted(by_size.items()):
+        if size < 3:
+            continue
+        indices = numpy.array(same_size)
+        if indices.dtype.kind == "S":
+            indices = numpy.char.partition(indices, b"/")[..., 0]
+        indices = indices.astype(numpy.int64)
+        for i in range(1, size - 1):
+            triangles.append(indices[:, [0, i, i + 1]])
+    return numpy.vstack(triangles)
+
+
+def _read_stl(filename, mmap):
+    # Read a binary or ASCII STL file. STL triangles do not share their
+    # vertices, identical vertices are merged.
+    
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        header = f.read(84)
+        count = int(numpy.frombuffer(header[80:84], dtype="<u4")[0]) \
+                if len(header) == 84 else -1
+        if size == 84 + count * _stl_dtype.itemsize:
+            if mmap:
+                records = numpy.memmap(filename, _stl_dtype, "r", 84,
+                                       (count,))
+            else:
+                records = numpy.fromfile(f, _stl_dtype, count)
+            corners = records["vertices"].reshape(-1, 3)
+        else:
+            tokens = numpy.array((header + f.read()).split())
+            positions = numpy.flatnonzero(tokens == b"vertex")
+            corners = tokens[positions[:, None] + [1, 2, 3]].astype(
+                                                            numpy.float64)
+    
+    vertices, inverse = numpy.unique(corners, axis=0, return_inverse=True)
+    return (vertices.astype(numpy.float64),
+            inverse.reshape(-1, 3).astype(numpy.int64))
+
+
+_ply_types = {"char": "i1", "int8": "i1", "uchar": "u1", "uint8": "u1",
+              "short": "i2", "int16": "i2", "ushort": "u2", "uint16": "u2",
+              "int": "i4", "int32": "i4", "uint": "u4", "uint32": "u4",
+              "float": "f4", "float32": "f4", "double": "f8", "float64": "f8"}
+
+_ply_byte_orders = {"binary_little_endian": "<", "binary_big_endian": ">",
+                    "ascii": None}
+
+
+def _read_ply(filename, mmap):
+    # Read a binary or ASCII PLY file. Only the vertex positions and the
+    # vertex indices of the faces are used.
+    
+    with open(filename, "rb") as f:
+        byte_order = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError("Invalid PLY file: " + filename)
+            words = line.decode("ascii").split()
+            if not words or words[0] in ("ply", "comment", "obj_info"):
+                continue
+            if words[0] == "end_header":
+                break
+            if words[0] == "format":
+                byte_order = _ply_byte_orders[words[1]]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property":
+                elements[-1][2].append(words[1:])
+        
+        if byte_order is None:
+            return _read_ply_ascii(f, elements)
+        
+        vertices = None
+        triangles = None
+        offset = f.tell()
+        for name, count, properties in elements:
+            if vertices is not None and triangles is not None:
+                break
+            if all(property_[0] != "list" for property_ in properties):
+                dtype = numpy.dtype([(property_[1],
+                                      byte_order + _ply_types[property_[0]])
+                                     for property_ in properties])
+                if mmap:
+                    records = numpy.memmap(filename, dtype, "r", offset,
+                                           (count,))
+                else:
+                    f.seek(offset)
+                    records = numpy.fromfile(f, dtype, count)
+                offset += count * dtype.itemsize
+                if name == "vertex":
+                    vertices = numpy.column_stack([records["x"], records["y"],
+                                                   records["z"]]).astype(
+                                                            numpy.float64)
+            elif name == "face":
+                f.seek(offset)
+                triangles, offset = _read_ply_faces(f, count, properties,
+                                                    byte_order)
+            else:
+                raise ValueError("Unsupported PLY element: " + name)
+    return vertices, triangles
+
+
+def _read_ply_faces(f, count, properties, byte_order):
+    # Read the binary face records at the position of the file f, and
+    # return the triangles and the offset of the end of the records.
+    # The vertex indices are the first list property. When all the faces
+    # are triangles the records have the same size and are read at once,
+    # otherwise they are read one at a time.
+    
+    fields = []
+    for i, property_ in enumerate(properties):
+        if property_[0] == "list":
+            fields.append(("count{0}".format(i),
+                           byte_order + _ply_types[property_[1]]))
+            fields.append(("items{0}".format(i),
+                           byte_order + _ply_types[property_[2]], (3,)))
+        else:
+            fields.append(("value{0}".format(i),
+                           byte_order + _ply_types[property_[0]]))
+    index = [property_[0] for property_ in properties].index("list")
+    
+    offset = f.tell()
+    dtype = numpy.dtype(fields)
+    records = numpy.fromfile(f, dtype, count)
+    if (len(records) == count and
+            all((records["count{0}".format(i)] == 3).all()
+                for i, property_ in enumerate(properties)
+                if property_[0] == "list")):
+        return (records["items{0}".format(index)].astype(numpy.int64),
+                offset + count * dtype.itemsize)
+    
+    f.seek(offset)
+    polygons = []
+    for _ in range(count):
+        for i, property_ in enumerate(properties):
+            if property_[0] == "list":
+                count_dtype = numpy.dtype(byte_order + _ply_types[property_[1]])
+                item_dtype = numpy.dtype(byte_order + _ply_types[property_[2]])
+                size = int(numpy.fromfile(f, count_dtype, 1)[0])
+                items = numpy.fromfile(f, item_dtype, size)
+                if i == index:
+                    polygons.append(items)
+            else:
+                f.seek(numpy.dtype(_ply_types[property_[0]]).itemsize, 1)
+    return _polygon_triangles(polygons), f.tell()
+
+
+def _read_ply_ascii(f, elements):
+    # Read the elements of an ASCII PLY file from the position of the
+    # file f
+    
+    lines = f.read().splitlines()
+    vertices = None
+    triangles = None
+    start = 0
+    for name, count, properties in elements:
+        element_lines = lines[start:start + count]
+        start += count
+        if name == "vertex":
+            columns = [property_[-1] for property_ in properties]
+            values = numpy.array(b" ".join(element_lines).split(),
+                                 dtype=numpy.float64).reshape(count, -1)
+            vertices = values[:, [columns.index(axis)
+                                  for axis in ("x", "y", "z")]]
+        elif name == "face":
+            # The vertex indices list is assumed to be the first property
+            polygons = []
+            for line in element_lines:
+                tokens = line.split()
+                size = int(tokens[0])
+                polygons.append(tokens[1:size + 1])
+            triangles = _polygon_triangles(polygons)
+    return vertices, triangles
+
+
+_mesh_readers_by_extension = ((".obj", _read_obj),
+                              (".stl", _read_stl),
+                              (".ply", _read_ply))
+
+_mesh_readers = tuple(extension
+                      for extension, reader in _mesh_readers_by_extension)
+
+
+class VoxelGrid(object):
+    """A regular grid of material ids, made by voxelize.
+    
+    ids is the (nx, ny, nz) array of the material id of each voxel, 0
+    for the empty voxels. The center of the voxel (i, j, k) is at
+    origin + (i + 0.5, j + 0.5, k + 0.5) * pitch. materials maps each
+    material name to its id.
+    
+    """
+    
+    def __init__(self, ids, origin, pitch, materials):
+        self._ids = ids
+        self._origin = origin
+        self._pitch = pitch
+        self._materials = materials
+        
+    @property
+    def ids(self):
+        return self._ids
+    
+    @property
+    def origin(self):
+        return self._origin
+    
+    @property
+    def pitch(self):
+        return self._pitch
+    
+    @property
+    def materials(self):
+        return self._materials
+    
+    @property
+    def shape(self):
+        return self._ids.shape
+    
+    
+def voxelize(csg_objects, pitch, bounds = None, material_ids = None,
+             max_workers = None):
+    """Voxelize the csg_objects into a VoxelGrid of material ids.
+    
+    pitch is the size of the voxels, either a number or one per axis.
+    bounds is the (min, max) pair of corners of the grid, by default the
+    bounding box of all the objects. A voxel gets the material of the
+    objects containing its center, objects later in the sequence taking
+    precedence where they overlap. The material ids are taken from the
+    material_ids dictionary, or else numbered from 1 in order of
+    appearance.
+    The inside of each mesh is found by ray parity along z, so meshes
+    must be closed. The grid is split into slabs along x, processed by
+    the pool of max_workers processes (by default the number of
+    processors) of start_process_pool.
+    
+    """
+    
+    import multiprocessing
+    
+    csg_objects = list(csg_objects)
+    evaluate_parallel(csg_objects)
+    material_ids, dtype = _number_materials(csg_objects, material_ids)
+    
+    pitch = numpy.ones(3) * numpy.asarray(pitch, dtype=numpy.float64)
+    if bounds is None:
+        bounds = _joined_bounding_box(csg_objects)
+    origin = numpy.asarray(bounds[0], dtype=numpy.float64)
+    shape = numpy.maximum(numpy.ceil((numpy.asarray(bounds[1]) - origin) /
+                                     pitch).astype(int), 1)
+    
+    meshes = []
+    for csg_object in csg_objects:
+        vertices, triangles = _mesh_arrays(*csg_object._global_mesh())
+        corners = vertices[triangles]
+        if len(corners):
+            meshes.append((corners, material_ids[csg_object.mat]))
+    
+    # Each slab only gets the triangles overlapping its voxel centers
+    max_workers = max_workers or multiprocessing.cpu_count()
+    edges = numpy.unique(numpy.linspace(0, shape[0],
+                                        min(shape[0], 4 * max_workers) + 1
+                                        ).astype(int))
+    slabs = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        low = origin[0] + (start + 0.5) * pitch[0]
+        high = origin[0] + (stop - 0.5) * pitch[0]
+        slab_meshes = []
+        for corners, id_ in meshes:
+            x = corners[:, :, 0]
+            mask = (x.min(axis=1) <= high) & (x.max(axis=1) >= low)
+            slab_meshes.append((corners[mask], id_))
+        slab_origin = origin + [start * pitch[0], 0.0, 0.0]
+        slabs.append((slab_meshes, slab_origin, pitch,
+                      (stop - start, shape[1], shape[2]), dtype))
+    
+    executor = None
+    if max_workers > 1 and len(slabs) > 1:
+        executor = start_process_pool(max_workers)
+    if executor is None:
+        results = [_voxelize_slab(*slab) for slab in slabs]
+    else:
+        results = list(executor.map(_voxelize_slab, *zip(*slabs)))
+    return VoxelGrid(numpy.concatenate(results, axis=0), origin, pitch,
+                     material_ids)
+
+
+def _number_materials(csg_objects, material_ids):
+    # Return the material_ids dictionary, or if None the materials of the
+    # csg_objects numbered from 1 in order of appearance, and the smallest
+    # dtype holding the ids and 0
+    
+    if material_ids is None:
+        material_ids = {}
+        for csg_object in csg_objects:
+            material_ids.setdefault(csg_object.mat, len(material_ids) + 1)
+    dtype = numpy.min_scalar_type(max(list(material_ids.values()) + [0]))
+    return material_ids, dtype
+
+
+def _joined_bounding_box(csg_objects):
+    # The bounding box of all the csg_objects, a zero box at the origin
+    # if all are empty
+    
+    boxes = [csg_object.bounding_box for csg_object in csg_objects
+             if csg_object.bounding_box is not None]
+    if not boxes:
+        return numpy.zeros(3), numpy.zeros(3)
+    return (numpy.min([box[0] for box in boxes], axis=0),
+            numpy.max([box[1] for box in boxes], axis=0))
+
+
+def _voxelize_slab(meshes, origin, pitch, shape, dtype):
+    # Make the grid of material ids of a slab, painting the meshes in
+    # order
+    
+    ids = numpy.zeros(shape, dtype=dtype)
+    for corners, id_ in meshes:
+        ids[_parity_fill(corners, origin, pitch, shape)] = id_
+    return ids
+
+
+def _parity_fill(corners, origin, pitch, shape, chunk_size = 1 << 20):
+    # Find the voxels of the grid whose centers are inside the closed mesh
+    # of the (M, 3, 3) corners of the triangles.
+    # A ray along z is cast from each column of voxel centers: at each
+    # crossing with a triangle the inside state toggles for all the
+    # centers above it. The toggles are accumulated with a cumulative
+    # xor along z. Edge and vertex hits follow the top-left rule of
+    # rasterization, so that a ray hits exactly one of the triangles
+    # sharing an edge.
+    
+    nx, ny, nz = shape
+    toggles = numpy.zeros((nx, ny, nz + 1), dtype=numpy.uint8)
+    
+    # In grid coordinates voxel centers are at integer positions
+    a, b, c, area = _counterclockwise_triangles((corners - origin) / pitch -
+                                                0.5)
+    
+    xy = numpy.stack([a[:, :2], b[:, :2], c[:, :2]], axis=1)
+    low = numpy.maximum(numpy.ceil(xy.min(axis=1)), 0).astype(numpy.int64)
+    high = numpy.minimum(numpy.floor(xy.max(axis=1)),
+                         [nx - 1, ny - 1]).astype(numpy.int64)
+    widths = numpy.maximum(high - low + 1, 0)
+    counts = widths[:, 0] * widths[:, 1]
+    
+    # Process the (triangle, column) pairs in chunks of bounded size
+    ends = numpy.cumsum(counts)
+    start = 0
+    while start < len(counts):
+        stop = max(int(numpy.searchsorted(ends, ends[start] - counts[start] +
+                                          chunk_size, "right")), start + 1)
+        chunk = slice(start, stop)
+        start = stop
+        
+        chunk_counts = counts[chunk]
+        total = int(chunk_counts.sum())
+        if not total:
+            continue
+        triangle = numpy.repeat(numpy.arange(len(chunk_counts)), chunk_counts)
+        offset = numpy.arange(total) - numpy.repeat(
+                        numpy.cumsum(chunk_counts) - chunk_counts, chunk_counts)
+        width_y = widths[chunk, 1][triangle]
+        i = low[chunk, 0][triangle] + offset // width_y
+        j = low[chunk, 1][triangle] + offset % width_y
+        
+        inside, z = _ray_hits(a[chunk][triangle], b[chunk][triangle],
+                              c[chunk][triangle], area[chunk][triangle], i, j)
+        k = numpy.clip(numpy.ceil(z[inside]), 0, nz).astype(numpy.int64)
+        flat = numpy.ravel_multi_index((i[inside], j[inside], k),
+                                       toggles.shape)
+        flat, hits = numpy.unique(flat, return_counts=True)
+        toggles.ravel()[flat[hits % 2 == 1]] ^= 1
+    
+    return numpy.bitwise_xor.accumulate(toggles, axis=2)[:, :, :nz] == 1
+
+
+def _counterclockwise_triangles(corners):
+    # Split the (M, 3, 3) corners of the triangles into the a, b, c arrays
+    # of corners, counterclockwise in the xy plane, and the doubled areas
+    # of the projections. Triangles parallel to z are never crossed by
+    # rays along z and are dropped.
+    
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    area = ((b[:, 0] - a[:, 0]) * (c[:, 1] - a[:, 1]) -
+            (b[:, 1] - a[:, 1]) * (c[:, 0] - a[:, 0]))
+    keep = area != 0.0
+    a, b, c, area = a[keep], b[keep], c[keep], area[keep]
+    clockwise = area < 0.0
+    b, c = numpy.where(clockwise[:, None], c, b), numpy.where(
+                                                    clockwise[:, None], b, c)
+    return a, b, c, numpy.abs(area)
+
+
+def _ray_hits(a, b, c, area, x, y):
+    # Test the rays along z through the points (x, y) against the
+    # triangles of corners a, b, c, one triangle per ray, as given by
+    # _counterclockwise_triangles. Return the mask of the rays crossing
+    # their triangle and the heights of the crossings.
+    # Edge and vertex hits follow the top-left rule of rasterization, so
+    # that a ray hits exactly one of the triangles sharing an edge.
+    
+    inside = numpy.ones(len(x), dtype=bool)
+    weights = []
+    corners = (a, b, c)
+    for u, v in ((1, 2), (2, 0), (0, 1)):
+        # The edge function is evaluated from the same endpoint in both
+        # the triangles sharing the edge, so that the results are exactly
+        # opposite
+        swap = ((corners[u][:, 0] > corners[v][:, 0]) |
+                ((corners[u][:, 0] == corners[v][:, 0]) &
+                 (corners[u][:, 1] > corners[v][:, 1])))
+        start = numpy.where(swap[:, None], corners[v], corners[u])
+        end = numpy.where(swap[:, None], corners[u], corners[v])
+        dx = end[:, 0] - start[:, 0]
+        dy = end[:, 1] - start[:, 1]
+        edge = dx * (y - start[:, 1]) - dy * (x - start[:, 0])
+        edge = numpy.where(swap, -edge, edge)
+        dx = numpy.where(swap, -dx, dx)
+        dy = numpy.where(swap, -dy, dy)
+        top_left = (dy < 0.0) | ((dy == 0.0) & (dx > 0.0))
+        inside &= (edge > 0.0) | ((edge == 0.0) & top_left)
+        weights.append(edge)
+    
+    # Relative to a corner, the height is exact for horizontal triangles
+    z = a[:, 2] + (weights[1] * (b[:, 2] - a[:, 2]) +
+                   weights[2] * (c[:, 2] - a[:, 2])) / area
+    return inside, z
+
+
+class _BVH(object):
+    """A bounding volume hierarchy of triangles, answering point \
+    containment queries by ray parity.
+    
+    The triangles are sorted along a Morton curve of their centroids in
+    the xy plane and grouped in leaves of leaf_size consecutive
+    triangles. The nodes form a complete binary tree stored as a heap:
+    node 1 is the root, the children of node i are 2i and 2i + 1, and
+    the leaves are the last nodes. Rays are cast along z, and are
+    traversed through the tree in batches.
+    
+    """
+    
+    def __init__(self, geometry, corners, leaf_size = 8):
+        
+        # The geometry the hierarchy was built for
+        self.geometry = geometry
         
-        """
+        self.leaf_size = leaf_size
+        a, b, c, area = _counterclockwise_triangles(corners)
         
-        return self.difference(other)
-    
-    def __mul__(self, other):
-        """Perform intersection of CSGObjects.
+        # Sort the triangles along the Morton curve
+        centroids = (a + b + c)[:, :2] / 3.0
+        if len(centroids):
+            low = centroids.min(axis=0)
+            extent = numpy.maximum(centroids.max(axis=0) - low, 1e-300)
+            cells = numpy.minimum((centroids - low) / extent * 65536.0,
+                                  65535).astype(numpy.uint64)
+        else:
+            cells = numpy.zeros((0, 2), dtype=numpy.uint64)
+        codes = _spread_bits(cells[:, 0]) | (_spread_bits(cells[:, 1]) << 1)
+        order = numpy.argsort(codes, kind="mergesort")
+        self.a, self.b, self.c = a[order], b[order], c[order]
+        self.area = area[order]
         
-        Attributes such as creation position, material, color are taken
-        from the first object.
+        # Bounds of the leaves, empty leaves padding the tree have empty
+        # bounds
+        leaf_count = 1
+        while leaf_count * leaf_size < len(order):
+            leaf_count *= 2
+        self.leaf_count = leaf_count
+        triangles = numpy.stack([self.a, self.b, self.c], axis=1)
+        padded = numpy.full((leaf_count * leaf_size, 3, 3), numpy.nan)
+        padded[:len(order)] = triangles
+        padded = padded.reshape(leaf_count, leaf_size * 3, 3)
+        low = numpy.full((2 * leaf_count, 3), numpy.inf)
+        high = numpy.full((2 * leaf_count, 3), -numpy.inf)
+        filled = numpy.arange(leaf_count) * leaf_size < len(order)
+        low[leaf_count:][filled] = numpy.nanmin(padded[filled], axis=1)
+        high[leaf_count:][filled] = numpy.nanmax(padded[filled], axis=1)
         
-        """
+        # Bounds of the inner nodes, level by level up to the root
+        count = leaf_count // 2
+        while count:
+            nodes = numpy.arange(count, 2 * count)
+            low[nodes] = numpy.minimum(low[2 * nodes], low[2 * nodes + 1])
+            high[nodes] = numpy.maximum(high[2 * nodes], high[2 * nodes + 1])
+            count //= 2
+        self.low = low
+        self.high = high
         
-        return self.intersection(other)
+    def contains(self, points, chunk_size = 1 << 16):
+        """Return the boolean mask of the (N, 3) points inside the mesh."""
+        
+        inside = numpy.zeros(len(points), dtype=bool)
+        for start in range(0, len(points), chunk_size):
+            chunk = points[start:start + chunk_size]
+            point, triangle = self._candidates(chunk)
+            coordinates = chunk[point]
+            hit, z = _ray_hits(self.a[triangle], self.b[triangle],
+                               self.c[triangle], self.area[triangle],
+                               coordinates[:, 0], coordinates[:, 1])
+            hit &= z > coordinates[:, 2]
+            crossings = numpy.bincount(point[hit], minlength=len(chunk))
+            inside[start:start + chunk_size] = crossings % 2 == 1
+        return inside
     
-    def __xor__(self, other):
-        """Perform symmetric_difference of CSGObjects.
+    def _candidates(self, points):
+        # Traverse the tree with the rays starting from the points, and
+        # return the (point, triangle) pairs of the triangles in the
+        # leaves whose bounds the rays cross
         
-        Attributes such as creation position, material, color are taken
-        from the first object.
+        point = numpy.arange(len(points))
+        node = numpy.ones(len(points), dtype=numpy.int64)
+        leaf_points = []
+        leaf_nodes = []
+        while len(point):
+            coordinates = points[point]
+            crossed = ((coordinates[:, 0] >= self.low[node, 0]) &
+                       (coordinates[:, 0] <= self.high[node, 0]) &
+                       (coordinates[:, 1] >= self.low[node, 1]) &
+                       (coordinates[:, 1] <= self.high[node, 1]) &
+                       (coordinates[:, 2] <= self.high[node, 2]))
+            point, node = point[crossed], node[crossed]
+            leaf = node >= self.leaf_count
+            leaf_points.append(point[leaf])
+            leaf_nodes.append(node[leaf])
+            point = numpy.repeat(point[~leaf], 2)
+            node = (2 * node[~leaf][:, None] + [0, 1]).ravel()
+            
+        point = numpy.repeat(numpy.concatenate(leaf_points), self.leaf_size)
+        triangle = ((numpy.concatenate(leaf_nodes) - self.leaf_count) *
+                    self.leaf_size)
+        triangle = (triangle[:, None] + numpy.arange(self.leaf_size)).ravel()
+        valid = triangle < len(self.area)
+        return point[valid], triangle[valid]
+    
+    
+def _spread_bits(values):
+    # Interleave zero bits between the lowest 16 bits of the values, to
+    # make Morton codes
+    
+    values = values & numpy.uint64(0xFFFF)
+    values = (values | (values << numpy.uint64(8))) & numpy.uint64(0x00FF00FF)
+    values = (values | (values << numpy.uint64(4))) & numpy.uint64(0x0F0F0F0F)
+    values = (values | (values << numpy.uint64(2))) & numpy.uint64(0x33333333)
+    values = (values | (values << numpy.uint64(1))) & numpy.uint64(0x55555555)
+    return values
+
+
+def material_at(csg_objects, points, material_ids = None):
+    """Return the material id of the csg_objects at each of the (N, 3) \
+    points, 0 outside all of them.
+    
+    Objects later in the sequence take precedence where they overlap.
+    The material ids are taken from the material_ids dictionary, or else
+    numbered from 1 in order of appearance. See CSGObject.contains.
+    
+    """
+    
+    csg_objects = list(csg_objects)
+    material_ids, dtype = _number_materials(csg_objects, material_ids)
+    
+    points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+    ids = numpy.zeros(len(points), dtype=dtype)
+    for csg_object in csg_objects:
+        bounding_box = csg_object.bounding_box
+        if bounding_box is None:
+            continue
         
-        """
+        # Only the points in the bounding box are tested
+        candidates = numpy.flatnonzero(
+                        numpy.all((points >= bounding_box[0]) &
+                                  (points <= bounding_box[1]), axis=1))
+        inside = csg_object.contains(points[candidates])
+        ids[candidates[inside]] = material_ids[csg_object.mat]
+    return ids
+
+
+class MaterialOctree(object):
+    """A sparse octree of material ids, made by build_octree.
+    
+    The nodes are stored in arrays in breadth first order, the eight
+    children of a node being contiguous. children holds the index of the
+    first child of each node, or -1 for the leaves, and ids the material
+    id of each leaf, 0 where empty. The child of index i covers the
+    octant with bit 0 of i set for the upper half along x, bit 1 along y
+    and bit 2 along z. The root is the cube of the given size with the
+    minimum corner at origin. materials maps each material name to its
+    id.
+    
+    """
+    
+    def __init__(self, children, ids, origin, size, materials):
+        self._children = children
+        self._ids = ids
+        self._origin = origin
+        self._size = size
+        self._materials = materials
         
-        return self.symmetric_difference(other)
+    @property
+    def children(self):
+        return self._children
     
-    def __copy__(self):
+    @property
+    def ids(self):
+        return self._ids
+    
+    @property
+    def origin(self):
+        return self._origin
+    
+    @property
+    def size(self):
+        return self._size
+    
+    @property
+    def materials(self):
+        return self._materials
+    
+    def __len__(self):
+        return len(self._children)
+    
+    def material_at(self, points):
+        """Return the material ids at the (N, 3) points, 0 outside the \
+        root cube."""
         
-        new_object = CSGObject(copy.copy(self._pos),
-                               self._polyhedron,
-                               self.mat,
-                               copy.copy(self.color),
-                               copy.copy(self.transform))
-        return new_object
+        points = numpy.asarray(points, dtype=numpy.float64).reshape(-1, 3)
+        position = (points - self._origin) / self._size
+        result = numpy.zeros(len(points), dtype=self._ids.dtype)
+        inside = numpy.all((position >= 0.0) & (position < 1.0), axis=1)
+        position = position[inside]
+        node = numpy.zeros(len(position), dtype=numpy.int64)
+        active = numpy.arange(len(position))
+        while len(active):
+            first = self._children[node[active]]
+            inner = first >= 0
+            active, first = active[inner], first[inner]
+            position[active] *= 2.0
+            octant = numpy.minimum(position[active], 1.999999).astype(int)
+            position[active] -= octant
+            node[active] = first + octant.dot([1, 2, 4])
+        result[inside] = self._ids[node]
+        return result
     
-    def export(self, filename, **keywords):
-        """Export the CSGObject of file.
+    def export(self, filename):
+        """Export the octree to a NumPy .npz file."""
         
-        Currently only xml format is supported.
-        Only the material, color, geometry and transform are exported.
+        if _skip_export(filename):
+            return
+        names = sorted(self._materials, key=self._materials.get)
+        numpy.savez(filename, children=self._children, ids=self._ids,
+                    origin=self._origin, size=self._size,
+                    materials=numpy.array(names),
+                    material_numbers=numpy.array([self._materials[name]
+                                                  for name in names]))
         
-        """
         
-        if filename.endswith(".xml"):
-            root_element = Et.Element("py_csg_script_data")
-            mesh_filename = filename[:-4]
-            if "mesh_format" in keywords.keys():
-                mesh_filename += keywords["mesh_format"]
-            else:
-                mesh_filename += ".obj"
-            self._polyhedron.save_mesh(mesh_filename)
-            obj_element = self._make_xml_element(mesh_filename)
-            root_element.append(obj_element)
-            el_tree = Et.ElementTree(root_element)
-            el_tree.write(filename)
+def import_octree(filename):
+    """Import a MaterialOctree from a file written by its export."""
     
-    def import_(self, filename):
-        """Import the CSGObject from file.
+    with numpy.load(filename) as data:
+        materials = dict(zip(data["materials"].tolist(),
+                             data["material_numbers"].tolist()))
+        return MaterialOctree(data["children"], data["ids"], data["origin"],
+                              float(data["size"]), materials)
+                              
+                              
+def build_octree(csg_objects, max_depth, bounds = None, material_ids = None):
+    """Build a MaterialOctree of the materials of the csg_objects.
+    
+    The cells crossed by the surface of an object are split down to
+    max_depth, the others are leaves. Leaves get the material of the
+    objects containing their center, objects later in the sequence
+    taking precedence where they overlap, and siblings with the same
+    material are merged, so the memory used grows with the area of the
+    material interfaces rather than with the volume. bounds is the
+    (min, max) pair of corners to cover, by default the bounding box of
+    all the objects, enlarged to a cube. See voxelize for the material
+    ids.
+    
+    """
+    
+    csg_objects = list(csg_objects)
+    evaluate_parallel(csg_objects)
+    material_ids, dtype = _number_materials(csg_objects, material_ids)
+    
+    if bounds is None:
+        bounds = _joined_bounding_box(csg_objects)
+    origin = numpy.asarray(bounds[0], dtype=numpy.float64)
+    size = float((numpy.asarray(bounds[1]) - origin).max()) or 1.0
+    
+    corners = [numpy.zeros((0, 3, 3))]
+    for csg_object in csg_objects:
+        vertices, triangles = _mesh_arrays(*csg_object._global_mesh())
+        corners.append(vertices[triangles])
+    corners = numpy.concatenate(corners)
+    normals = numpy.cross(corners[:, 1] - corners[:, 0],
+                          corners[:, 2] - corners[:, 0])
+    
+    # Split the cells level by level. Each level is described by the
+    # integer coordinates of its cells and the (cell, triangle) pairs of
+    # the triangles crossing them.
+    octants = numpy.array(list(itertools.product((0, 1), repeat=3)))[:, ::-1]
+    levels = []
+    cells = numpy.zeros((1, 3), dtype=numpy.int64)
+    pair_cell = numpy.zeros(len(corners), dtype=numpy.int64)
+    pair_triangle = numpy.arange(len(corners))
+    for depth in range(max_depth + 1):
+        cell_size = size / 2 ** depth
+        crossed = _cells_crossed(cells, cell_size, origin, pair_cell,
+                                 pair_triangle, corners, normals)
+        pair_cell, pair_triangle = pair_cell[crossed], pair_triangle[crossed]
+        split = numpy.zeros(len(cells), dtype=bool)
+        if depth < max_depth:
+            split[pair_cell] = True
+        levels.append((cells, split))
+        if not split.any():
+            break
         
-        Currently only xml format is supported.
-        Only the material, color, geometry and transform are imported.
+        # The children of the split cells, and the pairs of each child
+        # with the triangles of its parent
+        child_number = numpy.cumsum(split) - 1
+        cells = (2 * cells[split][:, None] + octants).reshape(-1, 3)
+        pair_cell = (8 * child_number[pair_cell][:, None] +
+                     numpy.arange(8)).ravel()
+        pair_triangle = numpy.repeat(pair_triangle, 8)
+    
+    # Classify the centers of the leaves
+    centers = numpy.concatenate([origin + (cells[~split] + 0.5) *
+                                 size / 2 ** depth
+                                 for depth, (cells, split) in enumerate(levels)])
+    leaf_ids = material_at(csg_objects, centers, material_ids)
+    
+    # Lay the nodes out in breadth first order
+    children = []
+    ids = []
+    start = 0
+    offset = 0
+    for depth, (cells, split) in enumerate(levels):
+        count = len(cells) - split.sum()
+        level_ids = numpy.zeros(len(cells), dtype=dtype)
+        level_ids[~split] = leaf_ids[offset:offset + count]
+        offset += count
+        first = numpy.full(len(cells), -1, dtype=numpy.int64)
+        first[split] = start + len(cells) + 8 * numpy.arange(split.sum())
+        start += len(cells)
+        children.append(first)
+        ids.append(level_ids)
+    return _merge_octree_leaves(MaterialOctree(numpy.concatenate(children),
+                                               numpy.concatenate(ids),
+                                               origin, size, material_ids),
+                                [len(cells) for cells, split in levels])
+
+
+def _cells_crossed(cells, cell_size, origin, pair_cell, pair_triangle,
+                   corners, normals):
+    # Test the (cell, triangle) pairs for overlap, conservatively: the
+    # bounding box of the triangle must overlap the cell, and the plane
+    # of the triangle must cross it
+    
+    low = origin + cells[pair_cell] * cell_size
+    high = low + cell_size
+    triangles = corners[pair_triangle]
+    overlap = numpy.all((triangles.min(axis=1) <= high) &
+                        (triangles.max(axis=1) >= low), axis=1)
+    normal = normals[pair_triangle]
+    center = low + cell_size / 2.0
+    distance = numpy.abs(((center - triangles[:, 0]) * normal).sum(axis=1))
+    radius = cell_size / 2.0 * numpy.abs(normal).sum(axis=1)
+    return overlap & (distance <= radius)
+
+
+def _merge_octree_leaves(octree, level_sizes):
+    # Merge the groups of eight sibling leaves with the same material
+    # into their parent, from the deepest level up, and drop the
+    # unreferenced nodes
+    
+    children = octree.children.copy()
+    ids = octree.ids.copy()
+    ends = numpy.cumsum(level_sizes)
+    for end, size in reversed(list(zip(ends, level_sizes))[:-1]):
+        parents = numpy.arange(end - size, end)
+        parents = parents[children[parents] >= 0]
+        first = children[parents]
+        siblings = first[:, None] + numpy.arange(8)
+        merge = (numpy.all(children[siblings] < 0, axis=1) &
+                 numpy.all(ids[siblings] == ids[first][:, None], axis=1))
+        ids[parents[merge]] = ids[first[merge]]
+        children[parents[merge]] = -1
+    
+    # Keep the nodes reachable from the root, in the same order
+    keep = numpy.zeros(len(children), dtype=bool)
+    keep[0] = True
+    for end, size in zip(ends, level_sizes):
+        parents = numpy.arange(end - size, end)
+        parents = parents[keep[parents] & (children[parents] >= 0)]
+        keep[(children[parents][:, None] + numpy.arange(8)).ravel()] = True
+    new_index = numpy.cumsum(keep) - 1
+    children = children[keep]
+    children[children >= 0] = new_index[children[children >= 0]]
+    return MaterialOctree(children, ids[keep], octree.origin, octree.size,
+                          octree.materials)
+
+
+class Instance(CSGObject):
+    """An instance of a source CSGObject.
+    
+    The instance shares the geometry of the source, only adding its own
+    transform, applied after the transform of the source. Material and
+    color are taken from the source unless provided.
+    Many instances of the same source cost a single mesh, which is also
+    shared by the preview and the export.
+    
+    """
+    
+    def __init__(self, source, transform = None, mat = None, color = None):
+        if transform is None:
+            transform = source.global_transform
+        else:
+            transform = numpy.dot(transform, source.global_transform)
+        CSGObject.__init__(self, source.pos, source._local_polyhedron,
+                           mat or source.mat, color or source.color,
+                           transform)
+        self._operation = source._operation
+        self._local_digest = source._local_digest
+        self._bvh = source._bvh
+        self._source = source
         
-        """
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._source = self._source
+        return new_obj
+    
+    @property
+    def source(self):
+        return self._source
         
-        if filename.endswith(".xml"):
-            e_tree = Et.parse(filename)
-            obj_element = e_tree.getroot().find("csg_obj")
-            if obj_element is None:
-                return
-            else:
-                mesh_filename = obj_element.get("filename")
-                self._polyhedron.load_mesh(mesh_filename)
-                
-                color_string = obj_element.get("color")
-                r = int(color_string[1:3], 16) / 255.0
-                g = int(color_string[3:5], 16) / 255.0
-                b = int(color_string[5:7], 16) / 255.0
-                a = int(color_string[7:9], 16) / 255.0
-                self.color = (r, g, b, a)
-                
-                self.mat = obj_element.get("mat")
-                
-                transform_e = obj_element.find("transform")
-                transform_list = []
-                for row_e in list(transform_e):
-                    row = []
-                    for el_e in list(row_e):
-                        row.append(float(el_e.text))
-                    transform_list.append(row)
-                self.transform = numpy.matrix(transform_list)
-                    
-    def _make_xml_element(self, filename):
-        # Make an xml element that stores the color, mat and
-        # the filename of the mesh
         
-        e = Et.Element("csg_obj", filename = filename)
+class CSGGroup(object):
+    """Represent a group of CSGObjects and CSGGroups that can be \
+    manipulated at once.
+    
+    The group has its own transform, applied to its members after their
+    own transforms. Transforming the group does not touch its members:
+    their global geometry is only recomputed when requested.
+    
+    """
+    
+    def __init__(self, csg_objects = None):
         
-        r = int(self.color[0] * 255.0) 
-        g = int(self.color[1] * 255.0)
-        b = int(self.color[2] * 255.0) 
-        a = int(self.color[3] * 255.0)
-        color_string = "#{0:02X}{1:02X}{2:02X}{3:02X}".format(r, g, b, a)
+        self._csg_objects = set([])
         
-        transform_e = Et.Element("transform")
-        for row in self.transform:
-            row_e = Et.Element("row")
-            transform_e.append(row_e)
-            for element in row.tolist()[0]:
-                el_e = Et.Element("element")
-                el_e.text = repr(element)
-                row_e.append(el_e)
-                
-        e.set("color", color_string)
-        e.set("mat", self.mat)
-        e.append(transform_e)
-        return e
+        # The group containing this group
+        self._parent = None
         
+        self._transform = numpy.identity(4)
         
-class CSGGroup(object):
-    """Represent a group of CSGObject that can be manipulated at once."""
-    
-    def __init__(self, csg_objects = None):
+        # Changed every time the transform changes, so that members can
+        # tell if their global caches are still valid
+        self._stamp = 0
         
         if csg_objects is not None:
-            self._csg_objects = set(csg_objects)
-        else:
-            self._csg_objects = set([]) 
+            for csg_object in csg_objects:
+                self.add(csg_object)
+                
+    @property
+    def transform(self):
+        """The 4x4 transform matrix of the group, as a float64 array."""
+        return self._transform
+    
+    @transform.setter
+    def transform(self, value):
+        self._transform = numpy.array(value, dtype=numpy.float64)
+        self._stamp = next(_stamps)
+    
+    @property
+    def global_transform(self):
+        """The transform of the group including the transforms of the \
+        groups containing it."""
         
+        if self._parent is None:
+            return self._transform
+        return self._parent.global_transform.dot(self._transform)
+    
+    @property
+    def parent(self):
+        """The CSGGroup containing the group, or None."""
+        return self._parent
+    
+    def __iter__(self):
+        return iter(self._csg_objects)
+    
+    def __len__(self):
+        return len(self._csg_objects)
     
     def add(self, csg_object):
-        """Add an object to the group."""
+        """Add an object or a group to the group.
+        
+        The global placement of the object is kept, if it belongs to
+        another group it is removed from it.
+        
+        """
+        
+        group = self
+        while group is not None:
+            if group is csg_object:
+                raise ValueError("A group cannot contain itself")
+            group = group._parent
+        
+        global_transform = csg_object.global_transform
+        if csg_object._parent is not None:
+            csg_object._parent._csg_objects.discard(csg_object)
+        csg_object._parent = self
+        csg_object.transform = numpy.linalg.solve(self.global_transform,
+                                                  global_transform)
         self._csg_objects.add(csg_object)
         
     def remove(self, csg_object):
-        """Remove an object to the group."""
+        """Remove an object to the group, keeping its global placement."""
+        
+        global_transform = csg_object.global_transform
         self._csg_objects.remove(csg_object)
+        csg_object._parent = None
+        csg_object.transform = global_transform
         
     def translate(self, offset):
         """Translate the group by offset."""
-        for obj in self._csg_objects:
-            obj.translate(offset)
+        
+        offset = numpy.asarray(offset, dtype=numpy.float64)
+        transform = self._transform.copy()
+        transform[:3] += numpy.outer(offset, transform[3])
+        self._transform = transform
+        self._stamp = next(_stamps)
     
     def rotate(self, axis, origin, angle):
         """Rotate the group by angle degrees around the axis starting \
         at origin."""
-        for obj in self._csg_objects:
-            obj.rotate(axis, origin, angle)
+        
+        self._transform = _rotation_matrix(axis, origin, angle).dot(
+                                                            self._transform)
+        self._stamp = next(_stamps)
     
     def scale(self, factor, origin):
         """Scale by factor relative to origin."""
-        for obj in self._csg_objects:
-            obj.scale(factor, origin)
+        
+        self._transform = _scale_matrix(factor, origin).dot(self._transform)
+        self._stamp = next(_stamps)
+        
+    def _stamp_chain(self):
+        # The most recent stamp of this group and the groups containing
+        # it. Stamps always increase, so it changes whenever any of their
+        # transforms does.
+        
+        stamp = self._stamp
+        group = self._parent
+        while group is not None:
+            stamp = max(stamp, group._stamp)
+            group = group._parent
+        return stamp
             
     def __copy__(self):
         """Copy the group and each element of the group."""
+        
+        # Like copies of objects, the copy does not belong to the group
+        # of the original, so it takes the global transform
         csg_group = CSGGroup()
-        for csg_object in self.csg_objects:
+        csg_group._transform = self.global_transform.copy()
+        for csg_object in self._csg_objects:
             csg_copy = copy.copy(csg_object)
-            csg_group.add(csg_copy)
+            csg_copy._parent = csg_group
+            csg_copy.transform = csg_object.transform
+            csg_group._csg_objects.add(csg_copy)
         
         return csg_group
     
     
+# Source of the stamps of group transforms
+_stamps = itertools.count(1)
+    
+    
 class Box(CSGObject):
     """Box CSG primitive."""
     
     def __init__(self, pos, dim, mat = None, color = None):
-        polyhedron = csg.box(*dim)
+        polyhedron, digest = _primitive_polyhedron(_box, *dim)
         CSGObject.__init__(self, pos, polyhedron, mat, color)
+        self._local_digest = digest
         self.translate(pos)
         self._dim = dim
         
@@ -387,18 +3543,22 @@ class Box(CSGObject):
 class Cylinder(CSGObject):
     """Cylinder CSG primitive."""
     
-    def __init__(self, pos, radius, height, mat = None, color = None):
-        polyhedron = csg.cylinder(radius, height, True)
-        polyhedron = polyhedron.translate(0, height/2.0, 0)
+    def __init__(self, pos, radius, height, mat = None, color = None,
+                 resolution = None):
+        polyhedron, digest = _primitive_polyhedron(_cylinder, radius, height,
+                                                   _resolution(resolution))
         CSGObject.__init__(self, pos, polyhedron, mat, color)
+        self._local_digest = digest
         self.translate(pos)
         self._radius = radius
         self._height = height
+        self._resolution = resolution
      
     def __copy__(self):
         new_obj = CSGObject.__copy__(self)
         new_obj._radius = self._radius
         new_obj._height = self._height
+        new_obj._resolution = self._resolution
         return new_obj
     
     @property
@@ -409,41 +3569,62 @@ class Cylinder(CSGObject):
     def height(self):
         return self._height
 
+    @property
+    def resolution(self):
+        """The number of segments around the axis, None to use the one \
+        of the current quality mode."""
+        return self._resolution
+
 
 class Sphere(CSGObject):
     """Sphere CSG primitive."""
     
-    def __init__(self, pos, radius, mat = None, color = None):
-        polyhedron = csg.sphere(radius, True)
+    def __init__(self, pos, radius, mat = None, color = None,
+                 resolution = None):
+        polyhedron, digest = _primitive_polyhedron(_sphere, radius,
+                                                   _resolution(resolution))
         CSGObject.__init__(self, pos, polyhedron, mat, color)
+        self._local_digest = digest
         self.translate(pos)
         self._radius = radius
+        self._resolution = resolution
     
     def __copy__(self):
         new_obj = CSGObject.__copy__(self)
         new_obj._radius = self._radius
+        new_obj._resolution = self._resolution
         return new_obj
         
     @property
     def radius(self):
         return self._radius
+
+    @property
+    def resolution(self):
+        """The number of segments around the axis, None to use the one \
+        of the current quality mode."""
+        return self._resolution
     
     
 class Cone(CSGObject):
     """Cone CSG primitive """
     
-    def __init__(self, pos, radius, height, mat = None, color = None):
-        polyhedron = csg.cone(radius, height, True)
-        polyhedron = polyhedron.translate(0, height/2.0, 0)
+    def __init__(self, pos, radius, height, mat = None, color = None,
+                 resolution = None):
+        polyhedron, digest = _primitive_polyhedron(_cone, radius, height,
+                                                   _resolution(resolution))
         CSGObject.__init__(self, pos, polyhedron, mat, color)
+        self._local_digest = digest
         self.translate(pos)
         self._radius = radius
         self._height = height
+        self._resolution = resolution
      
     def __copy__(self):
         new_obj = CSGObject.__copy__(self)
         new_obj._radius = self._radius
         new_obj._height = self._height
+        new_obj._resolution = self._resolution
         return new_obj
     
     @property
@@ -454,21 +3635,33 @@ class Cone(CSGObject):
     def height(self):
         return self._height
 
+    @property
+    def resolution(self):
+        """The number of segments around the axis, None to use the one \
+        of the current quality mode."""
+        return self._resolution
+
 
 class Torus(CSGObject):
     """ Torus CSG primitive """
     
-    def __init__(self, pos, radius_major, radius_minor, mat = None, color = None):
-        polyhedron = csg.torus(radius_major, radius_minor, True)
+    def __init__(self, pos, radius_major, radius_minor, mat = None, color = None,
+                 resolution = None):
+        polyhedron, digest = _primitive_polyhedron(_torus, radius_major,
+                                                   radius_minor,
+                                                   _resolution(resolution))
         CSGObject.__init__(self, pos, polyhedron, mat, color)
+        self._local_digest = digest
         self.translate(pos)
         self._radius_major = radius_major
         self._radius_minor = radius_minor
+        self._resolution = resolution
         
     def __copy__(self):
         new_obj = CSGObject.__copy__(self)
         new_obj._radius_major = self._radius_major
         new_obj._radius_minor = self._radius_minor
+        new_obj._resolution = self._resolution
         return new_obj
     
     @property
@@ -479,62 +3672,510 @@ class Torus(CSGObject):
     def radius_minor(self):
         return self._radius_minor
 
+    @property
+    def resolution(self):
+        """The number of segments around the axis, None to use the one \
+        of the current quality mode."""
+        return self._resolution
+
 
 class CoplanarityError(Exception):
     pass
   
   
 class Polyline(CSGObject):
-    """Polyline CSG primitive."""
+    """Polyline CSG primitive.
+    
+    The vertices can be given as a sequence of points or as a (N, 3)
+    NumPy array. They are kept as given unless simplify is True, then
+    repeated vertices and vertices lying on the segment between their
+    neighbours are removed. Profiles to be lofted should not be
+    simplified, loft joins vertices by index.
     
-    def __init__(self, pos, vertices, mat = None, color = None):
-        self._vertices = vertices
+    """
+    
+    def __init__(self, pos, vertices, mat = None, color = None,
+                 simplify = False):
+        self._vertices = numpy.array(vertices, dtype=numpy.float64)
+        if simplify:
+            self._vertices = _clean_polyline(self._vertices)
         
         if not self._check_coplanarity():
             raise CoplanarityError()
         
-        polyhedron = csg.extrusion(vertices, 0, 0, 0)
+        polyhedron = _kernel().extrusion(self._vertices, (0, 0, 0))
         CSGObject.__init__(self, pos, polyhedron, mat, color)
         self.translate(pos)
         
     def extrude(self, vector):
         """Extrude the polyline by vector."""
         
-        self._polyhedron = csg.extrusion(self._vertices, vector[0], vector[1], 
-                                       vector[2])
+        self._polyhedron = _kernel().extrusion(self._vertices, vector)
+        
+    def revolve(self, axis, origin = (0, 0, 0), angle = 360.0,
+                segments = None):
+        """Revolve the polyline by angle degrees around the axis starting \
+        at origin, in local space coordinates.
+        
+        segments is the number of steps of a full turn, if None the
+        resolution of the current quality mode is used.
+        
+        """
+        
+        self._check_profile()
+        segments = _generated_resolution(segments)
+        closed = abs(angle) >= 360.0
+        if closed:
+            steps = segments
+        else:
+            steps = max(int(numpy.ceil(segments * abs(angle) / 360.0)), 1) + 1
+        angles = numpy.radians(numpy.linspace(0.0, angle, steps,
+                                              endpoint=not closed))
+        
+        # Rodrigues' formula for all the angles at once
+        u = numpy.asarray(axis, dtype=numpy.float64)
+        u = u / numpy.linalg.norm(u)
+        origin = numpy.asarray(origin, dtype=numpy.float64)
+        points = self._vertices - origin
+        cos = numpy.cos(angles)[:, None, None]
+        sin = numpy.sin(angles)[:, None, None]
+        rings = (origin + points * cos + numpy.cross(u, points) * sin +
+                 numpy.outer(points.dot(u), u) * (1.0 - cos))
+        
+        self._polyhedron = _polyhedron_from_arrays(*_solid_arrays(rings,
+                                                                  closed))
+        
+    def sweep_along_path(self, path):
+        """Sweep the polyline along a path of points, in local space \
+        coordinates.
+        
+        The local space origin of the polyline follows the path, with
+        the plane of the polyline kept perpendicular to it and the least
+        possible twist. If the last point of the path equals the first,
+        the path is closed.
+        
+        """
+        
+        self._check_profile()
+        path = numpy.array(path, dtype=numpy.float64)
+        closed = (len(path) > 2 and
+                  numpy.linalg.norm(path[-1] - path[0]) <=
+                  coplanarity_threshold)
+        if closed:
+            path = path[:-1]
+        if len(path) < 2:
+            raise ValueError("The path needs at least two points")
+        
+        # Coordinates of the vertices in the plane of the polyline
+        normal = self._plane[1]
+        u = _perpendicular(normal)
+        v = numpy.cross(normal, u)
+        x = self._vertices.dot(u)
+        y = self._vertices.dot(v)
+        
+        frames_u, frames_v = _path_frames(path, closed)
+        rings = (path[:, None, :] + x[None, :, None] * frames_u[:, None, :] +
+                 y[None, :, None] * frames_v[:, None, :])
+        
+        self._polyhedron = _polyhedron_from_arrays(*_solid_arrays(rings,
+                                                                  closed))
+        
+    def loft(self, profiles):
+        """Make the solid passing through the polyline and each of the \
+        profiles in turn.
+        
+        profiles is a sequence of Polylines, which must have the same
+        number of vertices of this one. Vertices with the same index are
+        joined.
+        
+        """
+        
+        self._check_profile()
+        rings = [self._vertices]
+        to_local = numpy.linalg.inv(self.global_transform)
+        for profile in profiles:
+            if len(profile._vertices) != len(self._vertices):
+                raise ValueError("Profiles must have the same number of "
+                                 "vertices")
+            transform = to_local.dot(profile.global_transform)
+            rings.append(_transform_points(profile._vertices, transform))
+            
+        self._polyhedron = _polyhedron_from_arrays(
+                                    *_solid_arrays(numpy.array(rings), False))
         
     def __copy__(self):
         new_obj = CSGObject.__copy__(self)
+        new_obj._vertices = self._vertices
+        new_obj._plane = self._plane
         return new_obj
        
     @property
     def vertices(self):
-        return copy.copy(self._vertices)
+        """The (N, 3) array of vertices, in local space coordinates."""
+        return self._vertices.copy()
+    
+    @property
+    def plane(self):
+        """The plane of the vertices as a (point, unit normal) pair."""
+        return self._plane
     
+    def _check_profile(self):
+        # Check that the polyline can be the profile of a solid
+        
+        if self._plane is None:
+            raise ValueError("The polyline needs at least three vertices")
+        
     def _check_coplanarity(self):
-        # Check if vertices are coplanary, if not raise a
-        # CoplanaryError exception
+        # Fit a plane to the vertices and check that all of them are
+        # within coplanarity_threshold from it
         
-        if len(self._vertices) <= 3:
+        if len(self._vertices) < 3:
+            self._plane = None
             return True
         
-        # First 3 vertices determin the plane
-        v0 = self._vertices[0]
-        v1 = self._vertices[1]
-        v2 = self._vertices[2]
-        vertices = self._vertices[3:]
-        
-        # Check for other vertices in the same plane of the first 3
-        for v in vertices:
-            m = numpy.matrix([[v0[0], v0[1], v0[2], 1],
-                              [v1[0], v1[1], v2[2], 1],
-                              [v2[0], v2[1], v2[2], 1],
-                              [v[0], v[1], v[2], 1]])
-            det = numpy.linalg.det(m)
-            if det < - coplanarity_threshold or det > coplanarity_threshold:
-                return False
+        center = self._vertices.mean(axis=0)
+        centered = self._vertices - center
+        
+        # The normal of the least squares plane is the direction of
+        # least variance
+        normal = numpy.linalg.svd(centered, full_matrices=False)[2][-1]
+        self._plane = (center, normal)
+        
+        distances = numpy.abs(centered.dot(normal))
+        return bool(numpy.all(distances <= coplanarity_threshold))
+    
+    
+def _generated_resolution(resolution):
+    # The resolution for meshes generated with NumPy, which need one
+    # even if the quality mode uses the pyPolyCSG default
+    
+    resolution = _resolution(resolution)
+    if resolution is None:
+        return 48
+    return resolution
+
+
+def _perpendicular(vector):
+    # A unit vector perpendicular to the unit vector
+    
+    other = numpy.identity(3)[numpy.argmin(numpy.abs(vector))]
+    perpendicular = numpy.cross(vector, other)
+    return perpendicular / numpy.linalg.norm(perpendicular)
+
+
+def _path_frames(path, closed):
+    # Return the (u, v) unit vectors perpendicular to a path at each of
+    # its points, as two (M, 3) arrays, with rotation minimizing frames.
+    # For closed paths the residual twist is spread along the path.
+    
+    if closed:
+        tangents = numpy.roll(path, -1, axis=0) - numpy.roll(path, 1, axis=0)
+    else:
+        tangents = numpy.gradient(path, axis=0)
+    tangents /= numpy.linalg.norm(tangents, axis=1)[:, None]
+    
+    frames_u = numpy.empty_like(path)
+    frames_u[0] = _perpendicular(tangents[0])
+    
+    # Double reflection method, the only part that is inherently serial
+    for i in range(len(path) - 1):
+        v1 = path[i + 1] - path[i]
+        c1 = v1.dot(v1)
+        u_l = frames_u[i] - (2.0 / c1) * v1.dot(frames_u[i]) * v1
+        t_l = tangents[i] - (2.0 / c1) * v1.dot(tangents[i]) * v1
+        v2 = tangents[i + 1] - t_l
+        c2 = v2.dot(v2)
+        if c2 > 0.0:
+            u_l = u_l - (2.0 / c2) * v2.dot(u_l) * v2
+        frames_u[i + 1] = u_l / numpy.linalg.norm(u_l)
+        
+    if closed:
+        # Twist needed to match the frame carried around the loop
+        last = frames_u[-1] - frames_u[-1].dot(tangents[0]) * tangents[0]
+        twist = numpy.arctan2(numpy.cross(last, frames_u[0]).dot(tangents[0]),
+                              last.dot(frames_u[0]))
+        angles = twist * numpy.arange(len(path)) / float(len(path))
+        frames_v = numpy.cross(tangents, frames_u)
+        cos = numpy.cos(angles)[:, None]
+        sin = numpy.sin(angles)[:, None]
+        frames_u, frames_v = (cos * frames_u + sin * frames_v,
+                              cos * frames_v - sin * frames_u)
+        return frames_u, frames_v
+    
+    return frames_u, numpy.cross(tangents, frames_u)
+
+
+def _solid_arrays(rings, closed):
+    # Return the vertices and triangles arrays of the solid skinning a
+    # (K, N, 3) array of K rings of N points. If closed is True the last
+    # ring is joined to the first, otherwise the first and last rings
+    # are capped. Coincident vertices are welded.
+    
+    count, size = rings.shape[:2]
+    indices = numpy.arange(count * size).reshape(count, size)
+    if closed:
+        first, second = indices, numpy.roll(indices, -1, axis=0)
+    else:
+        first, second = indices[:-1], indices[1:]
+    first_next = numpy.roll(first, -1, axis=1)
+    second_next = numpy.roll(second, -1, axis=1)
+    triangles = [numpy.dstack((first, first_next, second_next)).reshape(-1, 3),
+                 numpy.dstack((first, second_next, second)).reshape(-1, 3)]
+    
+    if not closed:
+        # The caps must run opposite to the sides along their edges. The
+        # last cap reuses the triangles of the first when it is a scaled
+        # and moved copy of it, as for extrusions and sweeps.
+        cap = _triangulate_ring(rings[0])
+        triangles.append(indices[0][cap][:, ::-1])
+        if not _similar_rings(rings[0], rings[-1]):
+            cap = _triangulate_ring(rings[-1])
+        triangles.append(indices[-1][cap])
+        
+    vertices, triangles = _weld_arrays(rings.reshape(-1, 3),
+                                       numpy.vstack(triangles))
+    
+    # Make the triangles face outwards
+    if _signed_volume(vertices, triangles) < 0.0:
+        triangles = triangles[:, ::-1]
+    return vertices, triangles
+
+
+def _similar_rings(first, second):
+    # Check if the ring of points second is the ring first rotated,
+    # uniformly scaled and translated, so that both have the same
+    # triangulation
+    
+    first = first - first.mean(axis=0)
+    second = second - second.mean(axis=0)
+    u, _, vt = numpy.linalg.svd(first.T.dot(second))
+    rotation = u.dot(vt)
+    if numpy.linalg.det(rotation) <= 0.0:
+        return False
+    rotated = first.dot(rotation)
+    squares = (rotated * rotated).sum()
+    if squares == 0.0:
+        return False
+    factor = (rotated * second).sum() / squares
+    return factor > 0.0 and numpy.allclose(factor * rotated, second,
+                                           rtol=0.0,
+                                           atol=coplanarity_threshold)
+
+
+def _triangulate_ring(ring):
+    # Triangulate a planar ring of 3D points, return the (N - 2, 3)
+    # triangles indices following the ring order. Convex rings are
+    # triangulated as a fan, the others by ear clipping.
+    
+    center = ring.mean(axis=0)
+    normal = numpy.linalg.svd(ring - center, full_matrices=False)[2][-1]
+    u = _perpendicular(normal)
+    points = numpy.column_stack(((ring - center).dot(u),
+                                 (ring - center).dot(numpy.cross(normal, u))))
+    
+    # Clip counterclockwise, then restore the ring order
+    x, y = points[:, 0], points[:, 1]
+    area = (x * numpy.roll(y, -1) - numpy.roll(x, -1) * y).sum()
+    polygon = numpy.arange(len(ring))
+    if area < 0.0:
+        polygon = polygon[::-1]
+    
+    if numpy.all(_turns(points[polygon]) > 0.0):
+        triangles = numpy.column_stack((numpy.repeat(polygon[0],
+                                                     len(polygon) - 2),
+                                        polygon[1:-1], polygon[2:]))
+    else:
+        triangles = _clip_ears(points, polygon)
+    
+    if area < 0.0:
+        triangles = triangles[:, ::-1]
+    return triangles
+
+
+def _turns(points):
+    # The cross products of the edges entering and leaving each vertex
+    # of a closed 2D polygon, positive at the convex vertices of a
+    # counterclockwise polygon
+    
+    entering = points - numpy.roll(points, 1, axis=0)
+    leaving = numpy.roll(points, -1, axis=0) - points
+    return entering[:, 0] * leaving[:, 1] - entering[:, 1] * leaving[:, 0]
+
+
+def _clip_ears(points, polygon):
+    # Triangulate the counterclockwise polygon of 2D points, given as an
+    # array of indices, by ear clipping. At each pass all the ears are
+    # found at once and every other ear of each run of consecutive ones
+    # is clipped, non adjacent ears being independent.
+    
+    triangles = []
+    while len(polygon) > 3:
+        size = len(polygon)
+        ring = points[polygon]
+        previous = numpy.roll(numpy.arange(size), 1)
+        following = numpy.roll(numpy.arange(size), -1)
+        turns = _turns(ring)
+        reflex = numpy.flatnonzero(turns <= 0.0)
+        ears = turns > 0.0
+        
+        tips = numpy.flatnonzero(ears)
+        ears[tips[_blocked_ears(ring, reflex, tips, previous[tips],
+                                following[tips])]] = False
             
-        return True
+        if not ears.any():
+            # Degenerate polygon, clip the first vertex anyway
+            ears[0] = True
+        elif ears.all():
+            ears[1::2] = False
+            if size % 2:
+                ears[-1] = False
+        else:
+            # Keep the ears at even positions in their runs, counted from
+            # a vertex that is not an ear
+            shift = numpy.argmin(ears)
+            rolled = numpy.roll(ears, -shift)
+            index = numpy.arange(size)
+            starts = rolled & ~numpy.roll(rolled, 1)
+            run_start = numpy.maximum.accumulate(numpy.where(starts, index,
+                                                             0))
+            ears = numpy.roll(rolled & ((index - run_start) % 2 == 0), shift)
+        
+        clipped = numpy.flatnonzero(ears)
+        triangles.append(numpy.column_stack((polygon[previous[clipped]],
+                                             polygon[clipped],
+                                             polygon[following[clipped]])))
+        polygon = polygon[~ears]
+    if len(polygon) == 3:
+        triangles.append(polygon[None, :])
+    return numpy.vstack(triangles)
+
+
+def _blocked_ears(ring, reflex, tips, previous, following):
+    # Check which of the convex vertices tips of the counterclockwise
+    # ring of 2D points are not ears, because a reflex vertex other than
+    # their previous and following neighbours lies in their triangle.
+    # The reflex vertices are binned in a grid, and each triangle is only
+    # tested against the vertices in the cells overlapping its bounding
+    # box, in chunks of bounded size.
+    
+    blocked = numpy.zeros(len(tips), dtype=bool)
+    if not len(reflex) or not len(tips):
+        return blocked
+    corners = numpy.stack((ring[previous], ring[tips], ring[following]),
+                          axis=1)
+    
+    # Sort the reflex vertices by cell, column by column, so that the
+    # cells of a column overlapping a box are contiguous
+    points = ring[reflex]
+    size = max(int(numpy.sqrt(len(reflex))), 1)
+    origin = points.min(axis=0)
+    extent = points.max(axis=0) - origin
+    cell = numpy.where(extent > 0.0, extent / size, 1.0)
+    
+    def cell_of(positions):
+        return numpy.clip(numpy.floor((positions - origin) / cell),
+                          0, size - 1).astype(numpy.intp)
+    
+    keys = cell_of(points).dot([size, 1])
+    order = numpy.argsort(keys, kind="stable")
+    starts = numpy.searchsorted(keys[order], numpy.arange(size * size + 1))
+    low = cell_of(corners.min(axis=1))
+    high = cell_of(corners.max(axis=1))
+    
+    # The (triangle, column) pairs, then the range of sorted vertices
+    # in the cells of each pair
+    columns = high[:, 0] - low[:, 0] + 1
+    segment_tip = numpy.repeat(numpy.arange(len(tips)), columns)
+    column = low[segment_tip, 0] + numpy.arange(len(segment_tip)) - \
+             numpy.repeat(numpy.cumsum(columns) - columns, columns)
+    first = starts[column * size + low[segment_tip, 1]]
+    counts = starts[column * size + high[segment_tip, 1] + 1] - first
+    ends = numpy.cumsum(counts)
+    
+    budget = 1 << 20
+    start = 0
+    while start < len(segment_tip):
+        stop = max(numpy.searchsorted(ends, ends[start] - counts[start] +
+                                      budget, "right"), start + 1)
+        chunk_counts = counts[start:stop]
+        pair_tip = numpy.repeat(segment_tip[start:stop], chunk_counts)
+        offsets = numpy.arange(len(pair_tip)) - numpy.repeat(
+                        numpy.cumsum(chunk_counts) - chunk_counts,
+                        chunk_counts)
+        pair_point = reflex[order[numpy.repeat(first[start:stop],
+                                               chunk_counts) + offsets]]
+        inside = (_points_in_triangles(ring[pair_point],
+                                       corners[pair_tip]) &
+                  (pair_point != previous[pair_tip]) &
+                  (pair_point != following[pair_tip]))
+        blocked[pair_tip[inside]] = True
+        start = stop
+    return blocked
+
+
+def _points_in_triangles(points, corners):
+    # Check which 2D points are inside or on their counterclockwise
+    # triangle, given the (P, 2) array of points and the (P, 3, 2) array
+    # of the corners of their triangles
+    
+    def side(p, q):
+        return ((q[:, 0] - p[:, 0]) * (points[:, 1] - p[:, 1]) -
+                (q[:, 1] - p[:, 1]) * (points[:, 0] - p[:, 0]))
+    
+    a, b, c = corners[:, 0], corners[:, 1], corners[:, 2]
+    return (side(a, b) >= 0.0) & (side(b, c) >= 0.0) & (side(c, a) >= 0.0)
+
+
+def _weld_arrays(vertices, triangles):
+    # Merge the vertices closer than coplanarity_threshold and remove the
+    # triangles that become degenerate
+    
+    keys = numpy.round(vertices / coplanarity_threshold).astype(numpy.int64)
+    _, unique, inverse = numpy.unique(keys, axis=0, return_index=True,
+                                      return_inverse=True)
+    triangles = inverse.ravel()[triangles]
+    valid = ((triangles[:, 0] != triangles[:, 1]) &
+             (triangles[:, 1] != triangles[:, 2]) &
+             (triangles[:, 2] != triangles[:, 0]))
+    return vertices[unique], triangles[valid]
+
+
+def _signed_volume(vertices, triangles):
+    # The signed volume enclosed by a closed mesh, positive if the
+    # triangles face outwards
+    
+    a = vertices[triangles[:, 0]]
+    b = vertices[triangles[:, 1]]
+    c = vertices[triangles[:, 2]]
+    return (a * numpy.cross(b, c)).sum() / 6.0
+
+
+def _clean_polyline(vertices):
+    # Remove from a closed polyline the vertices equal to the previous
+    # one and the vertices lying on the segment between their neighbours.
+    # Collinearity is checked relative to the distance between the
+    # neighbours, so that finely sampled curves are not flattened.
+    
+    if len(vertices) > 1:
+        steps = vertices - numpy.roll(vertices, 1, axis=0)
+        lengths = numpy.sqrt((steps * steps).sum(axis=1))
+        vertices = vertices[lengths > coplanarity_threshold]
+    
+    if len(vertices) > 3:
+        previous = numpy.roll(vertices, 1, axis=0)
+        following = numpy.roll(vertices, -1, axis=0)
+        chords = following - previous
+        cross = numpy.cross(vertices - previous, chords)
+        
+        # Distance of each vertex from the line through its neighbours,
+        # relative to their distance, and whether it is between them
+        chord_squares = (chords * chords).sum(axis=1)
+        distances = numpy.sqrt((cross * cross).sum(axis=1)) / chord_squares
+        forward = ((vertices - previous) * (following - vertices)).sum(axis=1)
+        vertices = vertices[(distances > collinearity_threshold) |
+                            (forward <= 0.0)]
+        
+    return vertices
     
     
 class Trapeze(Polyline):
@@ -551,7 +4192,7 @@ class Trapeze(Polyline):
         Polyline.__init__(self, pos, vertices, mat, color)
     
     def __copy__(self):
-        new_obj = CSGObject.__copy__(self)
+        new_obj = Polyline.__copy__(self)
         new_obj._width = self._width
         new_obj._height = self._height
         new_obj._top = self._top
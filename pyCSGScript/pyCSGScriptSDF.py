@@ -0,0 +1,955 @@
+"""Signed distance field implementation of the pyCSGScript classes.
+
+Objects are represented by a function giving the signed distance of
+points from their surface, negative inside. Booleans combine the
+functions (minimum for the union, maximum for the intersection, maximum
+with the negation for the difference), so they cost nothing until the
+distances are evaluated, vectorized with NumPy over batches of points.
+Meshes for preview are extracted from a sampled grid of distances with
+marching tetrahedra.
+The classes mirror the ones of pyCSGScript, without the need for
+pyPolyCSG.
+
+"""
+
+import copy
+import itertools
+import numpy
+
+from pyCSGScript import _is_identity, _rotation_matrix, _scale_matrix, \
+                        _transform_points
+
+
+default_color = (0.5, 0.5, 0.5, 1)
+default_mat = ""
+coplanarity_threshold = 1e-5
+
+# The meshing quality mode, either "preview" or "final"
+quality = "final"
+
+# Number of grid cells along the longest side of the bounding box used
+# to mesh the objects for each quality mode
+resolutions = {"preview": 48, "final": 128}
+
+# Maximum number of points evaluated at once when sampling a grid
+sample_chunk_size = 1 << 20
+
+
+def _empty(points):
+    # The distance function of an empty object
+
+    return numpy.full(len(points), numpy.inf)
+
+
+class CSGObject(object):
+    """Represent a CSG object as a signed distance function and keeps \
+    material and color information."""
+
+    def __init__(self, pos = (0, 0, 0), function = None, bounds = None,
+                 mat = None, color = None, transform = None):
+        """Initialize a CSGObject with the given position, the signed \
+        distance function of (N, 3) arrays of points in local space \
+        coordinates, the (min, max) local bounding box, material and \
+        color, and transform.
+        """
+
+        # The construction position
+        self._pos = pos
+
+        # The group containing the object
+        self._parent = None
+
+        # The boolean operation combining the distances of the operands,
+        # for the objects made by _combine
+        self._operation = None
+        self._operands = ()
+
+        if function is not None:
+            self._function = function
+            self._bounds = bounds
+        else:
+            self._function = _empty
+            self._bounds = None
+
+        if transform is not None:
+            self.transform = transform
+        else:
+            self.transform = numpy.identity(4)
+
+        if mat:
+            self.mat = mat
+        else:
+            self.mat = default_mat
+
+        if color:
+            self.color = color
+        else:
+            self.color = default_color
+
+    @property
+    def pos(self):
+        """The construction position."""
+        return self._pos
+
+    @property
+    def transform(self):
+        """The transform from local to global space coordinates."""
+        return self._transform
+
+    @transform.setter
+    def transform(self, value):
+        self._transform = numpy.array(value, dtype=numpy.float64)
+
+    @property
+    def global_transform(self):
+        """The transform from local to global space coordinates, \
+        including the transforms of the groups containing the object."""
+
+        if self._parent is None:
+            return self._transform
+        return self._parent.global_transform.dot(self._transform)
+
+    @property
+    def parent(self):
+        """The CSGGroup containing the object, or None."""
+        return self._parent
+
+    @property
+    def bounding_box(self):
+        """The axis aligned bounding box in global space coordinates, \
+        as a (min, max) pair of arrays, or None if the object is empty."""
+
+        if self._bounds is None:
+            return None
+        corners = numpy.array(list(itertools.product(*zip(*self._bounds))),
+                              dtype=numpy.float64)
+        corners = _transform_points(corners, self.global_transform)
+        return corners.min(axis=0), corners.max(axis=0)
+
+    def distance(self, points):
+        """Return the signed distance of the points from the surface, \
+        negative inside.
+
+        points is an array of global space coordinates whose last axis
+        has length 3, the result has the shape of the other axes. The
+        distance is exact for rigid transforms, with scales it is a
+        lower bound of the magnitude, keeping the sign.
+
+        """
+
+        points = numpy.asarray(points, dtype=numpy.float64)
+        distances = _evaluate(self, points.reshape(-1, 3))
+        return distances.reshape(points.shape[:-1])
+
+    def sample(self, pitch, bounds = None):
+        """Sample the signed distance on a regular grid.
+
+        pitch is the spacing of the grid, either a number or one per
+        axis. bounds is the (min, max) pair of corners covered by the
+        grid, by default the bounding box enlarged by half a pitch, so
+        that flat faces of the bounding box fall between the samples.
+        Return the (nx, ny, nz) array of the distances at the points
+        origin + (i, j, k) * pitch, and the origin.
+
+        """
+
+        pitch = numpy.ones(3) * numpy.asarray(pitch, dtype=numpy.float64)
+        if bounds is None:
+            bounding_box = self.bounding_box
+            if bounding_box is None:
+                return numpy.zeros((0, 0, 0)), numpy.zeros(3)
+            bounds = (bounding_box[0] - pitch / 2.0,
+                      bounding_box[1] + pitch)
+        origin = numpy.asarray(bounds[0], dtype=numpy.float64)
+        shape = numpy.floor((numpy.asarray(bounds[1]) - origin) /
+                            pitch).astype(int) + 1
+
+        # Evaluate slabs of bounded size along x
+        axes = [origin[i] + numpy.arange(shape[i]) * pitch[i]
+                for i in range(3)]
+        values = numpy.empty(shape)
+        step = max(sample_chunk_size // (shape[1] * shape[2]), 1)
+        for start in range(0, shape[0], step):
+            grid = numpy.stack(numpy.meshgrid(axes[0][start:start + step],
+                                              axes[1], axes[2],
+                                              indexing="ij"), axis=-1)
+            values[start:start + step] = self.distance(grid)
+        return values, origin
+
+    def mesh(self, pitch = None, bounds = None):
+        """Return the (N, 3) array of vertices and the (M, 3) array of \
+        triangle indices of the surface, in global space coordinates.
+
+        The distance is sampled with the given pitch, by default the
+        longest side of the bounding box divided by the resolution of
+        the current quality, and the surface is extracted with marching
+        tetrahedra. See sample for the bounds.
+
+        """
+
+        if pitch is None:
+            bounding_box = self.bounding_box
+            if bounding_box is None:
+                return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=int)
+            size = (bounding_box[1] - bounding_box[0]).max()
+            pitch = size / resolutions[quality] if size > 0 else 1.0
+        pitch = numpy.ones(3) * numpy.asarray(pitch, dtype=numpy.float64)
+        values, origin = self.sample(pitch, bounds)
+        return _marching_tetrahedra(values, origin, pitch)
+
+    def translate(self, offset, local=False):
+        """Translate by offset.
+
+        If local is True, use local space coordinates. For objects in a
+        group, non local coordinates are the ones of the group.
+
+        """
+
+        offset = numpy.asarray(offset, dtype=numpy.float64)
+        transform = self._transform.copy()
+        if local:
+            transform[:, 3] += transform[:, :3].dot(offset)
+        else:
+            transform[:3] += numpy.outer(offset, transform[3])
+        self._transform = transform
+
+    def rotate(self, axis, origin, angle):
+        """Rotate by angle degrees, around the axis starting at origin."""
+
+        self._transform = _rotation_matrix(axis, origin, angle).dot(
+                                                            self._transform)
+
+    def scale(self, factor, origin):
+        """Scale by factor respect to origin"""
+
+        self._transform = _scale_matrix(factor, origin).dot(self._transform)
+
+    def union(self, csg_object):
+        """Return the object union of self and the csg_object.
+
+        Attributes such as creation position, material, color are taken
+        from the self object.
+
+        """
+
+        return _combine(_union, [self, csg_object])
+
+    def intersection(self, csg_object):
+        """Return the intersection object of self and the csg_object.
+
+        Attributes such as creation position, material, color are taken
+        from the self object.
+
+        """
+
+        return _combine(_intersection, [self, csg_object])
+
+    def difference(self, csg_object):
+        """Return the difference object of self and the csg_object.
+
+        Attributes such as creation position, material, color are taken
+        from the self object.
+
+        """
+
+        return _combine(_difference, [self, csg_object])
+
+    def symmetric_difference(self, csg_object):
+        """Return the symmetric_difference object of self and the \
+        csg_object.
+
+        Attributes such as creation position, material, color are taken
+        from the self object.
+
+        """
+
+        return _combine(_symmetric_difference, [self, csg_object])
+
+    def __add__(self, other):
+        return self.union(other)
+
+    def __sub__(self, other):
+        return self.difference(other)
+
+    def __mul__(self, other):
+        return self.intersection(other)
+
+    def __xor__(self, other):
+        return self.symmetric_difference(other)
+
+    def __copy__(self):
+
+        # The copy does not belong to the group of the object, so it
+        # takes the global transform to keep the same placement
+        new_object = CSGObject(copy.copy(self._pos), self._function,
+                               self._bounds, self.mat, copy.copy(self.color),
+                               self.global_transform)
+        new_object._operation = self._operation
+        new_object._operands = self._operands
+        return new_object
+
+
+def union_all(csg_objects):
+    """Return the union of all the csg_objects.
+
+    The distances of all the objects are combined at once.
+    Attributes such as creation position, material, color are taken
+    from the first object.
+
+    """
+
+    return _combine(_union, list(csg_objects))
+
+
+def intersection_all(csg_objects):
+    """Return the intersection of all the csg_objects.
+
+    The distances of all the objects are combined at once.
+    Attributes such as creation position, material, color are taken
+    from the first object.
+
+    """
+
+    return _combine(_intersection, list(csg_objects))
+
+
+def _combine(operation, csg_objects):
+    # Make the object of a boolean operation between the csg_objects.
+    # The operands are copied, so later changes to them do not affect the
+    # result, whose local space is the global space. Untransformed
+    # results of the same operation are merged into a single node, the
+    # difference only through its first operand, so chains such as
+    # a = a + b stay flat.
+
+    copies = [copy.copy(csg_object) for csg_object in csg_objects]
+    operands = []
+    for index, operand in enumerate(copies):
+        if (operand._operation is operation and
+                operation is not _symmetric_difference and
+                (index == 0 or operation is not _difference) and
+                _is_identity(operand.transform)):
+            operands.extend(operand._operands)
+        else:
+            operands.append(operand)
+
+    boxes = [operand.bounding_box for operand in operands]
+    result = CSGObject(copies[0].pos, _empty,
+                       _combine_bounds(operation, boxes),
+                       copies[0].mat, copies[0].color)
+    result._operation = operation
+    result._operands = tuple(operands)
+    return result
+
+
+def _evaluate(csg_object, points):
+    # The signed distances of the csg_object at the (N, 3) points in
+    # global space coordinates. The operands of boolean operations are
+    # evaluated in post-order with explicit stacks, as in the mesh
+    # implementation, so that deep expressions do not exceed the
+    # recursion limit.
+
+    values = []
+    stack = [(csg_object, points, None)]
+    while stack:
+        csg_object, points, stretch = stack.pop()
+        if stretch is None:
+            transform = csg_object.global_transform
+            points = _transform_points(points, numpy.linalg.inv(transform))
+
+            # The smallest stretch of the transform scales the distances
+            # without overestimating them
+            stretch = numpy.linalg.svd(transform[:3, :3],
+                                       compute_uv=False)[-1]
+            if csg_object._operation is not None:
+                stack.append((csg_object, None, stretch))
+                stack.extend((operand, points, None)
+                             for operand in reversed(csg_object._operands))
+                continue
+            distances = csg_object._function(points)
+        else:
+            count = len(csg_object._operands)
+            distances = csg_object._operation(values[-count:])
+            del values[-count:]
+        if stretch != 1.0:
+            distances = distances * stretch
+        values.append(distances)
+    return values[0]
+
+
+def _union(distances):
+    return numpy.minimum.reduce(distances)
+
+
+def _intersection(distances):
+    return numpy.maximum.reduce(distances)
+
+
+def _difference(distances):
+    return numpy.maximum(distances[0], -numpy.minimum.reduce(distances[1:]))
+
+
+def _symmetric_difference(distances):
+    first, second = distances
+    return numpy.minimum(numpy.maximum(first, -second),
+                         numpy.maximum(second, -first))
+
+
+def _combine_bounds(operation, boxes):
+    # The bounding box of the result of an operation between objects
+    # with the given bounding boxes
+
+    if operation is _difference:
+        return boxes[0]
+    if operation is _intersection:
+        if any(box is None for box in boxes):
+            return None
+        low = numpy.max([box[0] for box in boxes], axis=0)
+        high = numpy.min([box[1] for box in boxes], axis=0)
+        return (low, high) if numpy.all(low <= high) else None
+    boxes = [box for box in boxes if box is not None]
+    if not boxes:
+        return None
+    return (numpy.min([box[0] for box in boxes], axis=0),
+            numpy.max([box[1] for box in boxes], axis=0))
+
+
+def _tetrahedron_table():
+    # For each of the 16 cases of the inside (negative) corners of a
+    # tetrahedron, the triangles of the surface crossing it. Each
+    # triangle is given by its 3 edges, each edge by its inside corner
+    # and its outside corner.
+
+    table = []
+    for case in range(16):
+        inside = [i for i in range(4) if case & (1 << i)]
+        outside = [i for i in range(4) if not case & (1 << i)]
+        if len(inside) == 1:
+            table.append([[(inside[0], o) for o in outside]])
+        elif len(inside) == 3:
+            table.append([[(i, outside[0]) for i in inside]])
+        elif len(inside) == 2:
+            quad = [(inside[0], outside[0]), (inside[0], outside[1]),
+                    (inside[1], outside[1]), (inside[1], outside[0])]
+            table.append([[quad[0], quad[1], quad[2]],
+                          [quad[0], quad[2], quad[3]]])
+        else:
+            table.append([])
+    return table
+
+
+_tetrahedron_triangles = _tetrahedron_table()
+
+# The 6 tetrahedra of a cube sharing its main diagonal, each one as a
+# path of unit steps along the axes. The same split is used by all the
+# cubes, so neighbouring cubes split their common face in the same way.
+_tetrahedra = [[(0, 0, 0),
+                tuple(int(axis == order[0]) for axis in range(3)),
+                tuple(int(axis in order[:2]) for axis in range(3)),
+                (1, 1, 1)]
+               for order in itertools.permutations(range(3))]
+
+
+def _marching_tetrahedra(values, origin, pitch):
+    # Extract the zero level surface of a grid of distances, as a mesh
+    # of vertices and triangle indices. Each cube of the grid crossed by
+    # the surface is split into 6 tetrahedra, each one contributing up to
+    # 2 triangles. Vertices on the same grid edge are shared, and the
+    # triangles face the increasing distance.
+
+    shape = values.shape
+    if len(shape) != 3 or min(shape) < 2:
+        return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=numpy.int64)
+
+    flat_values = values.ravel()
+    indices = numpy.arange(flat_values.size).reshape(shape)
+    corners = {}
+    for offset in itertools.product((0, 1), repeat=3):
+        corners[offset] = indices[offset[0]:shape[0] - 1 + offset[0],
+                                  offset[1]:shape[1] - 1 + offset[1],
+                                  offset[2]:shape[2] - 1 + offset[2]].ravel()
+
+    # Only the cubes with corners on both sides of the surface
+    cube_values = numpy.stack([flat_values[corners[offset]]
+                               for offset in sorted(corners)])
+    active = ((cube_values.min(axis=0) < 0.0) &
+              (cube_values.max(axis=0) >= 0.0))
+
+    edges_inside = []
+    edges_outside = []
+    for tetrahedron in _tetrahedra:
+        points = numpy.stack([corners[offset][active]
+                              for offset in tetrahedron], axis=1)
+        case = (flat_values[points] < 0.0).dot([1, 2, 4, 8])
+        for case_, triangles in enumerate(_tetrahedron_triangles):
+            selected = points[case == case_]
+            if not triangles or not len(selected):
+                continue
+            for triangle in triangles:
+                edges_inside.append(numpy.stack(
+                        [selected[:, edge[0]] for edge in triangle], axis=1))
+                edges_outside.append(numpy.stack(
+                        [selected[:, edge[1]] for edge in triangle], axis=1))
+    if not edges_inside:
+        return numpy.zeros((0, 3)), numpy.zeros((0, 3), dtype=numpy.int64)
+    edges_inside = numpy.vstack(edges_inside).ravel()
+    edges_outside = numpy.vstack(edges_outside).ravel()
+
+    # Grid points with zero distance count as outside, the vertices of
+    # the edges ending there are not merged to keep the mesh manifold
+    keys = edges_inside * flat_values.size + edges_outside
+    _, first, inverse = numpy.unique(keys, return_index=True,
+                                     return_inverse=True)
+    triangles = inverse.reshape(-1, 3)
+
+    def position(index):
+        return origin + numpy.column_stack(numpy.unravel_index(index,
+                                                               shape)) * pitch
+
+    inside_position = position(edges_inside)
+    outside_position = position(edges_outside)
+    inside_value = flat_values[edges_inside[first]]
+    t = inside_value / (inside_value - flat_values[edges_outside[first]])
+    vertices = inside_position[first] + t[:, None] * (
+                        outside_position[first] - inside_position[first])
+
+    # Flip the triangles not facing the outside corner of their first
+    # edge. The orientation is taken from the triangle joining the
+    # midpoints of the edges, which is never degenerate.
+    midpoints = ((inside_position + outside_position) / 2.0).reshape(-1, 3, 3)
+    normals = numpy.cross(midpoints[:, 1] - midpoints[:, 0],
+                          midpoints[:, 2] - midpoints[:, 0])
+    direction = (outside_position - inside_position)[::3]
+    flip = (normals * direction).sum(axis=1) < 0.0
+    triangles[flip] = triangles[flip][:, ::-1]
+    return vertices, triangles
+
+
+def _box_distance(half):
+    # The distance function of a box centered at the origin
+
+    def function(points):
+        q = numpy.abs(points) - half
+        outside = numpy.sqrt((numpy.maximum(q, 0.0) ** 2).sum(axis=1))
+        return outside + numpy.minimum(q.max(axis=1), 0.0)
+    return function
+
+
+def _sphere_distance(radius):
+    # The distance function of a sphere centered at the origin
+
+    def function(points):
+        return numpy.sqrt((points ** 2).sum(axis=1)) - radius
+    return function
+
+
+def _radial(points):
+    # The distance of the points from the y axis
+
+    return numpy.hypot(points[:, 0], points[:, 2])
+
+
+def _cylinder_distance(radius, height):
+    # The distance function of a cylinder with the base centered at the
+    # origin, along the y axis
+
+    def function(points):
+        d = numpy.column_stack((_radial(points) - radius,
+                                numpy.abs(points[:, 1] - height / 2.0) -
+                                height / 2.0))
+        return (numpy.minimum(d.max(axis=1), 0.0) +
+                numpy.sqrt((numpy.maximum(d, 0.0) ** 2).sum(axis=1)))
+    return function
+
+
+def _cone_distance(radius, height):
+    # The distance function of a cone with the base centered at the
+    # origin, along the y axis
+
+    half = height / 2.0
+    k2 = numpy.array([-radius, height])
+
+    def function(points):
+        q = numpy.column_stack((_radial(points), points[:, 1] - half))
+
+        # Distance from the base and from the side
+        ca = numpy.column_stack((
+                q[:, 0] - numpy.minimum(q[:, 0],
+                                        numpy.where(q[:, 1] < 0.0,
+                                                    radius, 0.0)),
+                numpy.abs(q[:, 1]) - half))
+        t = numpy.clip(((numpy.array([0.0, half]) - q).dot(k2)) /
+                       k2.dot(k2), 0.0, 1.0)
+        cb = q - [0.0, half] + t[:, None] * k2
+        sign = numpy.where((cb[:, 0] < 0.0) & (ca[:, 1] < 0.0), -1.0, 1.0)
+        return sign * numpy.sqrt(numpy.minimum((ca ** 2).sum(axis=1),
+                                               (cb ** 2).sum(axis=1)))
+    return function
+
+
+def _torus_distance(radius_major, radius_minor):
+    # The distance function of a torus centered at the origin, around
+    # the y axis
+
+    def function(points):
+        return numpy.hypot(_radial(points) - radius_major,
+                           points[:, 1]) - radius_minor
+    return function
+
+
+def _polygon_distance(polygon):
+    # The signed distance in the plane from the boundary of a polygon
+    # given as a (N, 2) array of vertices
+
+    def function(points):
+        distance = ((points - polygon[0]) ** 2).sum(axis=1)
+        sign = numpy.ones(len(points))
+        for i in range(len(polygon)):
+            v, w = polygon[i], polygon[i - 1]
+            edge = w - v
+            offset = points - v
+            t = numpy.clip(offset.dot(edge) / edge.dot(edge), 0.0, 1.0)
+            closest = offset - t[:, None] * edge
+            distance = numpy.minimum(distance, (closest ** 2).sum(axis=1))
+
+            # Crossing number of a ray along x
+            above = points[:, 1] >= v[1]
+            below = points[:, 1] < w[1]
+            left = edge[0] * offset[:, 1] > edge[1] * offset[:, 0]
+            crossing = (above & below & left) | (~above & ~below & ~left)
+            sign[crossing] *= -1.0
+        return sign * numpy.sqrt(distance)
+    return function
+
+
+class CSGGroup(object):
+    """Represent a group of CSGObjects and CSGGroups that can be \
+    manipulated at once.
+
+    The group has its own transform, applied to its members after their
+    own transforms.
+
+    """
+
+    def __init__(self, csg_objects = None):
+
+        self._csg_objects = set([])
+
+        # The group containing this group
+        self._parent = None
+
+        self._transform = numpy.identity(4)
+
+        if csg_objects is not None:
+            for csg_object in csg_objects:
+                self.add(csg_object)
+
+    @property
+    def transform(self):
+        """The 4x4 transform matrix of the group, as a float64 array."""
+        return self._transform
+
+    @transform.setter
+    def transform(self, value):
+        self._transform = numpy.array(value, dtype=numpy.float64)
+
+    @property
+    def global_transform(self):
+        """The transform of the group including the transforms of the \
+        groups containing it."""
+
+        if self._parent is None:
+            return self._transform
+        return self._parent.global_transform.dot(self._transform)
+
+    @property
+    def parent(self):
+        """The CSGGroup containing the group, or None."""
+        return self._parent
+
+    def __iter__(self):
+        return iter(self._csg_objects)
+
+    def __len__(self):
+        return len(self._csg_objects)
+
+    def add(self, csg_object):
+        """Add an object or a group to the group.
+
+        The global placement of the object is kept, if it belongs to
+        another group it is removed from it.
+
+        """
+
+        group = self
+        while group is not None:
+            if group is csg_object:
+                raise ValueError("A group cannot contain itself")
+            group = group._parent
+
+        global_transform = csg_object.global_transform
+        if csg_object._parent is not None:
+            csg_object._parent._csg_objects.discard(csg_object)
+        csg_object._parent = self
+        csg_object.transform = numpy.linalg.solve(self.global_transform,
+                                                  global_transform)
+        self._csg_objects.add(csg_object)
+
+    def remove(self, csg_object):
+        """Remove an object to the group, keeping its global placement."""
+
+        global_transform = csg_object.global_transform
+        self._csg_objects.remove(csg_object)
+        csg_object._parent = None
+        csg_object.transform = global_transform
+
+    def translate(self, offset):
+        """Translate the group by offset."""
+
+        offset = numpy.asarray(offset, dtype=numpy.float64)
+        transform = self._transform.copy()
+        transform[:3] += numpy.outer(offset, transform[3])
+        self._transform = transform
+
+    def rotate(self, axis, origin, angle):
+        """Rotate the group by angle degrees around the axis starting \
+        at origin."""
+
+        self._transform = _rotation_matrix(axis, origin, angle).dot(
+                                                            self._transform)
+
+    def scale(self, factor, origin):
+        """Scale by factor relative to origin."""
+
+        self._transform = _scale_matrix(factor, origin).dot(self._transform)
+
+    def __copy__(self):
+        """Copy the group and each element of the group."""
+
+        # Like copies of objects, the copy does not belong to the group
+        # of the original, so it takes the global transform
+        csg_group = CSGGroup()
+        csg_group._transform = self.global_transform.copy()
+        for csg_object in self._csg_objects:
+            csg_copy = copy.copy(csg_object)
+            csg_copy._parent = csg_group
+            csg_copy.transform = csg_object.transform
+            csg_group._csg_objects.add(csg_copy)
+
+        return csg_group
+
+
+class Box(CSGObject):
+    """Box CSG primitive."""
+
+    def __init__(self, pos, dim, mat = None, color = None):
+        half = numpy.asarray(dim, dtype=numpy.float64) / 2.0
+        CSGObject.__init__(self, pos, _box_distance(half), (-half, half),
+                           mat, color)
+        self.translate(pos)
+        self._dim = dim
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._dim = self._dim
+        return new_obj
+
+    @property
+    def dim(self):
+        return self._dim
+
+
+class Cylinder(CSGObject):
+    """Cylinder CSG primitive."""
+
+    def __init__(self, pos, radius, height, mat = None, color = None):
+        CSGObject.__init__(self, pos, _cylinder_distance(radius, height),
+                           ((-radius, 0.0, -radius), (radius, height, radius)),
+                           mat, color)
+        self.translate(pos)
+        self._radius = radius
+        self._height = height
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._radius = self._radius
+        new_obj._height = self._height
+        return new_obj
+
+    @property
+    def radius(self):
+        return self._radius
+
+    @property
+    def height(self):
+        return self._height
+
+
+class Sphere(CSGObject):
+    """Sphere CSG primitive."""
+
+    def __init__(self, pos, radius, mat = None, color = None):
+        CSGObject.__init__(self, pos, _sphere_distance(radius),
+                           ((-radius,) * 3, (radius,) * 3), mat, color)
+        self.translate(pos)
+        self._radius = radius
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._radius = self._radius
+        return new_obj
+
+    @property
+    def radius(self):
+        return self._radius
+
+
+class Cone(CSGObject):
+    """Cone CSG primitive."""
+
+    def __init__(self, pos, radius, height, mat = None, color = None):
+        CSGObject.__init__(self, pos, _cone_distance(radius, height),
+                           ((-radius, 0.0, -radius), (radius, height, radius)),
+                           mat, color)
+        self.translate(pos)
+        self._radius = radius
+        self._height = height
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._radius = self._radius
+        new_obj._height = self._height
+        return new_obj
+
+    @property
+    def radius(self):
+        return self._radius
+
+    @property
+    def height(self):
+        return self._height
+
+
+class Torus(CSGObject):
+    """Torus CSG primitive."""
+
+    def __init__(self, pos, radius_major, radius_minor, mat = None,
+                 color = None):
+        extent = radius_major + radius_minor
+        CSGObject.__init__(self, pos,
+                           _torus_distance(radius_major, radius_minor),
+                           ((-extent, -radius_minor, -extent),
+                            (extent, radius_minor, extent)),
+                           mat, color)
+        self.translate(pos)
+        self._radius_major = radius_major
+        self._radius_minor = radius_minor
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._radius_major = self._radius_major
+        new_obj._radius_minor = self._radius_minor
+        return new_obj
+
+    @property
+    def radius_major(self):
+        return self._radius_major
+
+    @property
+    def radius_minor(self):
+        return self._radius_minor
+
+
+class CoplanarityError(Exception):
+    pass
+
+
+class Polyline(CSGObject):
+    """Polyline CSG primitive.
+
+    The polyline is a flat polygon with no volume until it is extruded.
+
+    """
+
+    def __init__(self, pos, vertices, mat = None, color = None):
+        self._vertices = numpy.array(vertices, dtype=numpy.float64)
+
+        # Fit a plane to the vertices, the normal is the direction of
+        # least variance
+        center = self._vertices.mean(axis=0)
+        centered = self._vertices - center
+        frame = numpy.linalg.svd(centered, full_matrices=False)[2]
+        if numpy.any(numpy.abs(centered.dot(frame[-1])) >
+                     coplanarity_threshold):
+            raise CoplanarityError()
+        self._frame = (center, frame)
+
+        CSGObject.__init__(self, pos, None, None, mat, color)
+        self.translate(pos)
+
+    def extrude(self, vector):
+        """Extrude the polyline by vector."""
+
+        vector = numpy.asarray(vector, dtype=numpy.float64)
+        center, frame = self._frame
+        polygon = _polygon_distance((self._vertices - center).dot(
+                                                            frame[:2].T))
+        thickness = vector.dot(frame[2])
+        if thickness == 0.0:
+            return
+
+        def function(points):
+            # Slide the points along the extrusion to the polygon plane
+            t = (points - center).dot(frame[2]) / thickness
+            flat = (points - center - t[:, None] * vector).dot(frame[:2].T)
+            d = numpy.column_stack((polygon(flat),
+                                    (numpy.abs(t - 0.5) - 0.5) *
+                                    abs(thickness)))
+            return (numpy.minimum(d.max(axis=1), 0.0) +
+                    numpy.sqrt((numpy.maximum(d, 0.0) ** 2).sum(axis=1)))
+
+        corners = numpy.vstack((self._vertices, self._vertices + vector))
+        self._function = function
+        self._bounds = (corners.min(axis=0), corners.max(axis=0))
+
+    def __copy__(self):
+        new_obj = CSGObject.__copy__(self)
+        new_obj._vertices = self._vertices
+        new_obj._frame = self._frame
+        return new_obj
+
+    @property
+    def vertices(self):
+        return self._vertices
+
+
+class Trapeze(Polyline):
+    """Trapeze CSG primitive."""
+
+    def __init__(self, pos, width, height, top, mat = None, color = None):
+        self._width = width
+        self._height = height
+        self._top = top
+        vertices = [(-width/2, -height/2, 0),
+                    (-top/2, height/2, 0),
+                    (top/2, height/2, 0),
+                    (width/2, -height/2, 0)]
+        Polyline.__init__(self, pos, vertices, mat, color)
+
+    def __copy__(self):
+        new_obj = Polyline.__copy__(self)
+        new_obj._width = self._width
+        new_obj._height = self._height
+        new_obj._top = self._top
+        return new_obj
+
+    @property
+    def width(self):
+        return self._width
+
+    @property
+    def height(self):
+        return self._height
+
+    @property
+    def top(self):
+        return self._top
@@ -1,8 +1,11 @@
 from distutils.core import setup
 
+# On Python 2 the parallel evaluation, voxelization and import use the
+# futures backport of concurrent.futures if installed ("pip install
+# futures"), otherwise they run serially.
 setup(name="pyCSGScript",
       version="0.1",
       description="Library for CSG, simulation oriented",
       author="Federica Mazza",
-      py_modules =["pyCSGScript"]
+      py_modules =["pyCSGScript", "pyCSGScriptSDF"]
       )
\ No newline at end of file
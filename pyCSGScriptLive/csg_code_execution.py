@@ -2,20 +2,24 @@ import numpy
 from PyQt4.QtCore import QObject, pyqtSignal
 from dynamic_code_execution import BaseCodeChecker, BaseCodeExecutor
 import pyCSGScript as csg
+import pyCSGScriptSDF as sdf
 
 
 class GLReadyObject:
-    def __init__(self, vertices, indices, normals, name, color):
+    def __init__(self, vertices, indices, normals, name, color, transform):
         """A prepared object stores the same information of a CSG \
         object pluse the name.
         
         This class is used for optimizzation purposes since the
         get_vertices() method of a polyedron require data copy.
+        The vertices are in local space coordinates, objects sharing
+        the same geometry share the same arrays.
         
         """
         self.vertices = vertices
         self.indices = indices
         self.normals = normals         
+        self.transform = transform
         self.ambient = color
         self.diffuse = color
         self.specular = color
@@ -52,33 +56,81 @@ def _calculate_vertex_normals(vertices, indices):
     return normals
 
 
-def _csg_object_to_glready_object(csg_object, name):
-    """Translate a csg_object with the given name to a GLReadyObject."""
+def _csg_object_to_glready_object(csg_object, name, meshes):
+    """Translate a csg_object with the given name to a GLReadyObject.
     
-    vertices = csg_object.global_polyhedron.get_vertices()
-    triangles = csg_object.global_polyhedron.get_triangles().astype('uint16')
-    indices = triangles.flatten()
-    normals = _calculate_vertex_normals(vertices, indices)
+    The meshes dictionary stores the mesh arrays already computed for
+    each shared geometry, so copies and instances are converted once.
+    
+    """
+    
+    key = id(csg_object._shared_geometry)
+    if key not in meshes:
+        polyhedron = csg_object._polyhedron
+        vertices = polyhedron.get_vertices()
+        triangles = polyhedron.get_triangles().astype('uint16')
+        indices = triangles.flatten()
+        normals = _calculate_vertex_normals(vertices, indices)
+        meshes[key] = (vertices, indices, normals)
+    vertices, indices, normals = meshes[key]
     return GLReadyObject(vertices,
                          indices,
                          normals,
                          name,
-                         csg_object.color)
+                         csg_object.color,
+                         csg_object.global_transform)
+
+
+def _sdf_object_to_glready_object(sdf_object, name):
+    """Translate a signed distance field object with the given name to \
+    a GLReadyObject, meshing it at the current quality.
+    
+    The vertex normals are the gradient of the distance, estimated by
+    central differences.
+    
+    """
+    
+    vertices, triangles = sdf_object.mesh()
+    step = 1e-4 * max(numpy.ptp(vertices, axis=0).max(), 1e-3) \
+           if len(vertices) else 1.0
+    normals = numpy.column_stack([
+                    sdf_object.distance(vertices + offset) -
+                    sdf_object.distance(vertices - offset)
+                    for offset in numpy.identity(3) * step])
+    lengths = numpy.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0.0] = 1.0
+    return GLReadyObject(vertices,
+                         triangles.astype('uint32').flatten(),
+                         normals / lengths[:, None],
+                         name,
+                         sdf_object.color,
+                         numpy.identity(4))
 
 
 def _extract_geometries_info(dict_):
     """Extract the csg objects contained into a dictionary and \
     convert them to GLReadyObjects"""
     
+    # Evaluate the pending operations of lazily built objects in parallel
+    csg.evaluate_parallel([csg_obj for csg_obj in dict_.itervalues()
+                           if isinstance(csg_obj, csg.CSGObject)])
+    
     processed_objects = set([])
     prepared_objects = []
+    meshes = {}
     for name, csg_obj in dict_.iteritems():
         if (isinstance(csg_obj, csg.CSGObject) and
                         csg_obj not in processed_objects):
             # Ensure there is only one entry for object
             processed_objects.add(csg_obj)
             prepared_objects.append(_csg_object_to_glready_object(csg_obj,
-                                                                    name))
+                                                                  name,
+                                                                  meshes))
+        elif (isinstance(csg_obj, sdf.CSGObject) and
+                        csg_obj not in processed_objects):
+            processed_objects.add(csg_obj)
+            prepared_objects.append(_sdf_object_to_glready_object(csg_obj,
+                                                                  name))
             
     return prepared_objects
 
@@ -124,6 +176,17 @@ class CodeExecutor(BaseCodeExecutor, QObject):
         BaseCodeExecutor.__init__(self)
         QObject.__init__(self)
         
+        # The tessellation quality the code is executed with, either
+        # "preview" or "final"
+        self.quality = "preview"
+        
+        # The quality of the objects of the current execution state
+        self._state_quality = None
+        
+        # If the boolean operations of the code are evaluated lazily,
+        # their evaluation is then run in parallel
+        self.lazy_evaluation = False
+        
     def on_execution_end(self):
         """Emits an executionEnd signal, extract csg objects \
         data and emit a csgDataChanged signal."""
@@ -135,4 +198,19 @@ class CodeExecutor(BaseCodeExecutor, QObject):
         render_ready_objects = _extract_geometries_info(self.exec_locals)
         self.csgDataChanged.emit(render_ready_objects)
         
-        
\ No newline at end of file
+    def _run_code(self):
+        # Run with the quality and evaluation mode of the executor, set
+        # once for the whole run. They are set on the modules, a star
+        # import in the code would only copy the values.
+        # Objects of different qualities are never combined: if the
+        # quality has changed the execution restarts from the beginning.
+        
+        quality = self.quality
+        if quality != self._state_quality:
+            if self._next_node_index:
+                self._reset_execution()
+            self._state_quality = quality
+        csg.quality = quality
+        sdf.quality = quality
+        csg.lazy_evaluation = self.lazy_evaluation
+        BaseCodeExecutor._run_code(self)
@@ -101,6 +101,7 @@ class GLPreviewWidget(QGLWidget):
         self.qglClearColor(QColor(64, 64,128))
         GL.glEnable(GL.GL_DEPTH_TEST)
         GL.glEnable(GL.GL_CULL_FACE)
+        GL.glEnable(GL.GL_NORMALIZE)
         GL.glEnable(GL.GL_BLEND)
         GL.glBlendFunc(GL.GL_SRC_ALPHA, GL.GL_ONE_MINUS_SRC_ALPHA)
         
@@ -205,8 +206,13 @@ class GLPreviewWidget(QGLWidget):
             GL.glNormalPointerf(obj.normals)
             GL.glVertexPointerf(obj.vertices)
 
+            # Objects are stored in local space coordinates, OpenGL
+            # expects the matrix in column-major order
+            GL.glPushMatrix()
+            GL.glMultMatrixd(numpy.ascontiguousarray(obj.transform.T))
             GL.glShadeModel(GL.GL_SMOOTH)
             GL.glDrawElementsui(GL.GL_TRIANGLES, obj.indices)
+            GL.glPopMatrix()
         
     def resizeGL(self, width, height):
         """Adjust the camera aspect ratio to match the view one."""
@@ -9,6 +9,7 @@ from PyQt4.QtCore import QCoreApplication
 from ui_mainwindow import Ui_MainWindow
 from preferencesdialog import PreferencesDialog
 from csg_code_execution import CodeChecker, CodeExecutor
+import pyCSGScript as csg
 
 
 _app_name = "PyCSGScriptLive"
@@ -146,6 +147,21 @@ class MainWindow(QMainWindow):
         else:
             self._auto_execution = value
         
+    @property
+    def lazy_evaluation(self):
+        """Whether the scripts are executed with lazy evaluation of the \
+        boolean operations, evaluated in parallel by a process pool."""
+        
+        return self.code_executor.lazy_evaluation
+    
+    @lazy_evaluation.setter
+    def lazy_evaluation(self, value):
+        # The pool processes are started here, from the main thread:
+        # the code is executed by another thread, that cannot fork safely
+        if value:
+            csg.start_process_pool()
+        self.code_executor.lazy_evaluation = value
+        
     def updateConsole(self, exec_stdout, exec_stderr, exec_globals,
                       exec_locals):
         """Updates the console with the execution output."""
@@ -264,6 +280,7 @@ class MainWindow(QMainWindow):
         
         self.settings.setValue("autoexecution", self._auto_execution)
         self.settings.setValue("code_check_delay", self.code_check_delay)
+        self.settings.setValue("lazy_evaluation", self.lazy_evaluation)
         self.settings.endGroup()
         
         # 3D View state
@@ -310,6 +327,7 @@ class MainWindow(QMainWindow):
         self._auto_execution = self.settings.value("autoexecution").toBool()
         self.code_check_delay = \
             self.settings.value("code_check_delay").toFloat()[0]
+        self.lazy_evaluation = self.settings.value("lazy_evaluation").toBool()
         self.settings.endGroup()
              
         self.editor.annotations_active = annotations_active
@@ -332,6 +350,8 @@ class MainWindow(QMainWindow):
             QMessageBox.about(self, "About PyCSGScriptLive", text)
             
     def runFromStart(self):
+        # Explicit runs produce final quality geometries
+        self.code_executor.quality = "final"
         self.code_executor.send_request(CodeExecutor.StopRequest())
         request = CodeChecker.CheckRequest(unicode(self.editor.text()),
                                                unicode(self.file_name),
@@ -499,6 +519,8 @@ class MainWindow(QMainWindow):
         pref_dialog.show()
         
     def _requestCheck(self):
+        # Runs while typing produce coarse geometries, faster to compute
+        self.code_executor.quality = "preview"
         request = CodeChecker.CheckRequest(unicode(self.editor.text()),
                                                unicode(self.file_name),
                                                self._auto_execution)
@@ -51,6 +51,7 @@ class PreferencesDialog(QDialog):
         # Initialize code preferences
         ui.autoExecutionCheckBox.setChecked(mainwindow.auto_execution)
         ui.checkDelaySpinBox.setValue(parent.code_check_delay)
+        ui.lazyEvaluationCheckBox.setChecked(mainwindow.lazy_evaluation)
         
         
         # Signals and slots connections
@@ -77,6 +78,7 @@ class PreferencesDialog(QDialog):
         # Set code preferences
         mainwindow.auto_execution = ui.autoExecutionCheckBox.isChecked()
         mainwindow.code_check_delay = ui.checkDelaySpinBox.value()
+        mainwindow.lazy_evaluation = ui.lazyEvaluationCheckBox.isChecked()
         
         self.hide()
         self.destroy()
@@ -117,6 +117,9 @@ class Ui_PreferencesDialog(object):
         self.label_5.setObjectName(_fromUtf8("label_5"))
         self.horizontalLayout_4.addWidget(self.label_5)
         self.verticalLayout_2.addLayout(self.horizontalLayout_4)
+        self.lazyEvaluationCheckBox = QtGui.QCheckBox(self.groupBox_4)
+        self.lazyEvaluationCheckBox.setObjectName(_fromUtf8("lazyEvaluationCheckBox"))
+        self.verticalLayout_2.addWidget(self.lazyEvaluationCheckBox)
         self.gridLayout.addWidget(self.groupBox_4, 1, 1, 1, 1)
         self.buttonBox = QtGui.QDialogButtonBox(PreferencesDialog)
         self.buttonBox.setStandardButtons(QtGui.QDialogButtonBox.Cancel|QtGui.QDialogButtonBox.Ok)
@@ -144,4 +147,5 @@ class Ui_PreferencesDialog(object):
         self.groupBox_4.setTitle(_translate("PreferencesDialog", "Code", None))
         self.autoExecutionCheckBox.setText(_translate("PreferencesDialog", "Auto Execution", None))
         self.label_5.setText(_translate("PreferencesDialog", "Check Delay", None))
+        self.lazyEvaluationCheckBox.setText(_translate("PreferencesDialog", "Lazy Evaluation", None))
 